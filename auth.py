@@ -1,38 +1,54 @@
 import pickle
 from pathlib import Path
 
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-
-from model import GoogleDrive
-
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ["https://www.googleapis.com/auth/drive"]
+ABOUT_URL = "https://www.googleapis.com/drive/v3/about?fields=user(emailAddress)"
+
+
+def fetch_email(creds):
+    # A single request, building a Drive service for it costs more
+    # pylint: disable=import-outside-toplevel
+    from google.auth.transport.requests import AuthorizedSession
+
+    resp = AuthorizedSession(creds).get(ABOUT_URL)
+    resp.raise_for_status()
+    return resp.json()["user"]["emailAddress"]
 
 
 def get_creds(email):
     creds = None
-    same_mail = True
+    user_email = email
 
     token_path = Path(f"{email}.gdrive")
     if token_path.exists():
         with token_path.open("rb") as f:
-            creds = pickle.load(f)
+            token = pickle.load(f)
+        # Older token files hold just the credentials
+        if isinstance(token, dict):
+            creds, user_email = token["creds"], token["email"]
+        else:
+            creds = token
 
     # If there are no (valid) credentials available, let the user log in
     if not creds or not creds.valid:
+        # The transport and the flow are imported here, most runs start with a
+        # valid token and need neither
         if creds and creds.expired and creds.refresh_token:
+            # pylint: disable=import-outside-toplevel
+            from google.auth.transport.requests import Request
+
             creds.refresh(Request())
         else:
+            # pylint: disable=import-outside-toplevel
+            from google_auth_oauthlib.flow import InstalledAppFlow
+
             flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
             creds = flow.run_local_server(port=0)
-
-        user_email = GoogleDrive(creds).email_address
-        if user_email != email:
-            same_mail = False
+            user_email = fetch_email(creds)
 
         token_path = Path(f"{user_email}.gdrive")
-        # Save the credentials for the next run
+        # Save the credentials for the next run, with the email they belong to
         with token_path.open("wb") as f:
-            pickle.dump(creds, f)
-    return (creds, same_mail)
+            pickle.dump({"creds": creds, "email": user_email}, f)
+    return (creds, user_email == email)
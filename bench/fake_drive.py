@@ -0,0 +1,420 @@
+import email.parser
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import googleapiclient
+
+FOLDER = "application/vnd.google-apps.folder"
+GOOGLE_PREFIX = "application/vnd.google-apps."
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")[:-6] + "Z"
+
+
+def select_fields(meta, fields):
+    # Understands the flat "files(a, b)" / "file(a, b)" selections used here
+    match = re.search(r"files?\(([^()]*)\)", fields or "")
+    if match is None:
+        return dict(meta)
+    keys = [x.strip() for x in match.group(1).split(",")]
+    return {x: meta[x] for x in keys if x in meta}
+
+
+class DriveError(Exception):
+    def __init__(self, status, reason, message=""):
+        super().__init__(message or reason)
+        self.status = status
+        self.reason = reason
+
+    def body(self):
+        error = {"code": self.status, "message": str(self)}
+        error["errors"] = [{"reason": self.reason, "message": str(self)}]
+        return json.dumps({"error": error}).encode()
+
+
+class DriveState:
+    def __init__(self, email="bench@example.com"):
+        self.email = email
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.files = {}
+        self.content = {}
+        self.children = {}
+        self.changes = []
+        self.sessions = {}
+        self.root_id = self._add({"name": "My Drive", "mimeType": FOLDER}, None)
+
+    def _new_id(self):
+        return f"f{next(self.ids):08d}"
+
+    def _add(self, meta, content, parents=()):
+        file_id = self._new_id()
+        mime = meta.get("mimeType") or "application/octet-stream"
+        file = {
+            "id": file_id,
+            "name": meta.get("name", "Untitled"),
+            "mimeType": mime,
+            "parents": list(parents),
+            "modifiedTime": meta.get("modifiedTime") or now(),
+            "webViewLink": f"https://drive.example.com/{file_id}",
+            "ownedByMe": True,
+            "trashed": False,
+        }
+        self.files[file_id] = file
+        self.children[file_id] = {}
+        for parent in parents:
+            self.children[parent][file_id] = None
+        if not mime.startswith(GOOGLE_PREFIX):
+            self._set_content(file_id, content or b"")
+        self.changes.append(file_id)
+        return file_id
+
+    def _set_content(self, file_id, content):
+        self.content[file_id] = bytes(content)
+        self.files[file_id]["md5Checksum"] = hashlib.md5(content).hexdigest()
+        self.files[file_id]["size"] = str(len(content))
+
+    def _get(self, file_id):
+        if file_id == "root":
+            file_id = self.root_id
+        if file_id not in self.files:
+            raise DriveError(404, "notFound", f"File not found: {file_id}")
+        return self.files[file_id]
+
+    def create(self, meta, content=None):
+        with self.lock:
+            parents = meta.get("parents") or [self.root_id]
+            for parent in parents:
+                self._get(parent)
+            return self.files[self._add(meta, content, parents)]
+
+    def update(
+        self, file_id, meta, add_parents=None, remove_parents=None, content=None
+    ):
+        with self.lock:
+            file = self._get(file_id)
+            if "name" in meta:
+                file["name"] = meta["name"]
+            for parent in filter(None, (remove_parents or "").split(",")):
+                file["parents"].remove(parent)
+                self.children[parent].pop(file["id"], None)
+            for parent in filter(None, (add_parents or "").split(",")):
+                self._get(parent)
+                file["parents"].append(parent)
+                self.children[parent][file["id"]] = None
+            if content is not None:
+                self._set_content(file["id"], content)
+            file["modifiedTime"] = now()
+            self.changes.append(file["id"])
+            return file
+
+    def copy(self, file_id, meta):
+        with self.lock:
+            file = self._get(file_id)
+            if file["mimeType"] == FOLDER:
+                raise DriveError(403, "cannotCopyFile", "Folders cannot be copied")
+            new_meta = {"name": meta.get("name", file["name"])}
+            new_meta["mimeType"] = file["mimeType"]
+            parents = meta.get("parents") or file["parents"]
+            content = self.content.get(file["id"])
+            return self.files[self._add(new_meta, content, parents)]
+
+    def delete(self, file_id):
+        with self.lock:
+            file = self._get(file_id)
+            for child in list(self.children[file["id"]]):
+                self.delete(child)
+            for parent in file["parents"]:
+                self.children[parent].pop(file["id"], None)
+            del self.files[file["id"]]
+            del self.children[file["id"]]
+            self.content.pop(file["id"], None)
+            self.changes.append(file["id"])
+
+    def list(self, query, page_size, page_token):
+        with self.lock:
+            match = re.search(r"'([^']+)' in parents", query or "")
+            if match is not None:
+                ids = list(self.children.get(self._get(match.group(1))["id"], ()))
+            else:
+                ids = [x for x in self.files if x != self.root_id]
+            start = int(page_token or 0)
+            end = start + page_size
+            files = [self.files[x] for x in ids[start:end]]
+            return files, (str(end) if end < len(ids) else None)
+
+    def list_changes(self, page_token, page_size):
+        with self.lock:
+            start = int(page_token) - 1
+            if start < 0 or start > len(self.changes):
+                raise DriveError(400, "invalid", "Invalid page token")
+            end = min(start + page_size, len(self.changes))
+            changes = []
+            for file_id in self.changes[start:end]:
+                if file_id in self.files:
+                    file = self.files[file_id]
+                    changes.append({"fileId": file_id, "removed": False, "file": file})
+                else:
+                    changes.append({"fileId": file_id, "removed": True})
+            if end < len(self.changes):
+                return {"changes": changes, "nextPageToken": str(end + 1)}
+            return {"changes": changes, "newStartPageToken": str(end + 1)}
+
+
+class FakeDrive:
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0, state=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.state = state or DriveState()
+        self.calls = Counter()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}/"
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def discovery_doc(self):
+        path = os.path.join(
+            os.path.dirname(googleapiclient.__file__),
+            "discovery_cache",
+            "documents",
+            "drive.v3.json",
+        )
+        with open(path) as f:
+            return f.read().replace("https://www.googleapis.com/", self.url)
+
+    def _handler(self):
+        drive = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if drive.latency:
+                    time.sleep(drive.latency)
+                status, headers, payload = drive.handle(
+                    self.command, self.path, dict(self.headers), body
+                )
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _respond
+
+        return Handler
+
+    def handle(self, method, path, headers, body):
+        headers = {k.lower(): v for k, v in headers.items()}
+        parts = urlsplit(path)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        route = parts.path.strip("/").split("/")
+        try:
+            if route[:3] == ["batch", "drive", "v3"]:
+                return self._batch(headers, body)
+            if route[:2] == ["upload", "session"]:
+                return self._session_put(route[2], headers, body)
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.calls["rate_limited"] += 1
+                raise DriveError(403, "userRateLimitExceeded", "Rate Limit Exceeded")
+            return self._route(method, route, query, headers, body)
+        except DriveError as e:
+            return e.status, {"Content-Type": "application/json"}, e.body()
+
+    def _json(self, value, status=200):
+        return status, {"Content-Type": "application/json"}, json.dumps(value).encode()
+
+    def _route(self, method, route, query, headers, body):
+        state = self.state
+        upload = route[0] == "upload"
+        if upload:
+            route = route[1:]
+        if route[:2] != ["drive", "v3"]:
+            raise DriveError(404, "notFound", "Unknown endpoint")
+        route = route[2:]
+        fields = query.get("fields")
+
+        if route == ["about"]:
+            self.calls["about.get"] += 1
+            return self._json({"user": {"emailAddress": state.email}})
+        if route == ["changes", "startPageToken"]:
+            self.calls["changes.getStartPageToken"] += 1
+            return self._json({"startPageToken": str(len(state.changes) + 1)})
+        if route == ["changes"]:
+            self.calls["changes.list"] += 1
+            page_size = int(query.get("pageSize", 100))
+            resp = state.list_changes(query.get("pageToken", "1"), page_size)
+            for change in resp["changes"]:
+                if "file" in change:
+                    change["file"] = select_fields(change["file"], fields)
+            return self._json(resp)
+
+        if route == ["files"] and method == "GET":
+            self.calls["files.list"] += 1
+            page_size = int(query.get("pageSize", 100))
+            files, token = state.list(query.get("q"), page_size, query.get("pageToken"))
+            resp = {"files": [select_fields(x, fields) for x in files]}
+            if token is not None:
+                resp["nextPageToken"] = token
+            return self._json(resp)
+
+        if route == ["files"] and method == "POST":
+            self.calls["files.create"] += 1
+            if upload:
+                return self._upload(None, query, headers, body)
+            return self._json(state.create(json.loads(body or b"{}")))
+
+        if len(route) == 3 and route[0] == "files" and route[2] == "copy":
+            self.calls["files.copy"] += 1
+            return self._json(state.copy(route[1], json.loads(body or b"{}")))
+
+        if len(route) == 2 and route[0] == "files":
+            file_id = route[1]
+            if method == "GET" and query.get("alt") == "media":
+                self.calls["files.get_media"] += 1
+                return self._media(file_id, headers)
+            if method == "GET":
+                self.calls["files.get"] += 1
+                return self._json(state._get(file_id))
+            if method == "DELETE":
+                self.calls["files.delete"] += 1
+                state.delete(file_id)
+                return 204, {}, b""
+            if method == "PATCH":
+                self.calls["files.update"] += 1
+                if upload:
+                    return self._upload(file_id, query, headers, body)
+                file = state.update(
+                    file_id,
+                    json.loads(body or b"{}"),
+                    query.get("addParents"),
+                    query.get("removeParents"),
+                )
+                return self._json(file)
+        raise DriveError(404, "notFound", "Unknown endpoint")
+
+    def _media(self, file_id, headers):
+        file = self.state._get(file_id)
+        content = self.state.content.get(file["id"], b"")
+        match = re.match(r"bytes=(\d+)-(\d*)", headers.get("range", ""))
+        if match is None:
+            return 200, {"Content-Type": "application/octet-stream"}, content
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(content) - 1
+        end = min(end, len(content) - 1)
+        if start >= len(content) and content:
+            raise DriveError(416, "requestedRangeNotSatisfiable")
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "Content-Range": f"bytes {start}-{max(end, start)}/{len(content)}",
+        }
+        return 206, headers, content[start : end + 1]
+
+    def _upload(self, file_id, query, headers, body):
+        upload_type = query.get("uploadType", "media")
+        if upload_type == "resumable":
+            session_id = uuid.uuid4().hex
+            self.state.sessions[session_id] = {
+                "file_id": file_id,
+                "meta": json.loads(body or b"{}"),
+                "data": bytearray(),
+            }
+            return 200, {"Location": f"{self.url}upload/session/{session_id}"}, b""
+        if upload_type == "multipart":
+            message = email.parser.BytesParser().parsebytes(
+                f"Content-Type: {headers['content-type']}\r\n\r\n".encode() + body
+            )
+            meta_part, media_part = message.get_payload()
+            meta = json.loads(meta_part.get_payload(decode=True) or b"{}")
+            content = media_part.get_payload(decode=True)
+        else:
+            meta, content = {}, body
+        return self._json(self._store(file_id, meta, content))
+
+    def _store(self, file_id, meta, content):
+        if file_id is None:
+            return self.state.create(meta, content)
+        return self.state.update(file_id, meta, content=content)
+
+    def _session_put(self, session_id, headers, body):
+        self.calls["upload.chunk"] += 1
+        session = self.state.sessions.get(session_id)
+        if session is None:
+            raise DriveError(404, "notFound", "Upload session expired")
+        match = re.match(
+            r"bytes (\*|(\d+)-(\d+))/(\d+|\*)", headers.get("content-range", "")
+        )
+        if match is not None and match.group(2) is not None:
+            if int(match.group(2)) != len(session["data"]):
+                raise DriveError(400, "badRange", "Chunk does not continue the upload")
+            session["data"].extend(body)
+        elif match is None:
+            session["data"].extend(body)
+        total = match.group(4) if match is not None else str(len(session["data"]))
+        if total != "*" and len(session["data"]) >= int(total):
+            del self.state.sessions[session_id]
+            file = self._store(session["file_id"], session["meta"], session["data"])
+            return self._json(file)
+        headers = {}
+        if session["data"]:
+            headers["Range"] = f"bytes=0-{len(session['data']) - 1}"
+        return 308, headers, b""
+
+    def _batch(self, headers, body):
+        self.calls["batch"] += 1
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {headers['content-type']}\r\n\r\n".encode() + body
+        )
+        boundary = uuid.uuid4().hex
+        out = []
+        for part in message.get_payload():
+            raw = part.get_payload(decode=False)
+            request_line, rest = raw.replace("\r\n", "\n").split("\n", 1)
+            method, path, _ = request_line.split(" ", 2)
+            head, _, sub_body = rest.partition("\n\n")
+            sub_headers = dict(
+                x.split(": ", 1) for x in head.split("\n") if ": " in x
+            )
+            status, _, payload = self.handle(
+                method, path, sub_headers, sub_body.encode()
+            )
+            content_id = part["Content-ID"][1:-1]
+            out.append(
+                f"--{boundary}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\n"
+                "Content-Type: application/json\r\n\r\n"
+                f"{payload.decode()}\r\n"
+            )
+        out.append(f"--{boundary}--\r\n")
+        headers = {"Content-Type": f"multipart/mixed; boundary={boundary}"}
+        return 200, headers, "".join(out).encode()
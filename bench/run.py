@@ -0,0 +1,218 @@
+import argparse
+import json
+import logging
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from google.oauth2.credentials import Credentials
+
+from bench.fake_drive import FOLDER, FakeDrive
+from bench.tree import generate, make_cloud_tree
+from metrics import Metrics
+from model import GoogleDrive
+from store import (
+    CloudSnapshot,
+    DownloadSessions,
+    HashCache,
+    SyncState,
+    UploadSessions,
+)
+
+results_path = Path(__file__).parent / "results.jsonl"
+
+
+def open_drive(fake, workers):
+    GoogleDrive.discovery_doc = fake.discovery_doc()
+    return GoogleDrive(
+        Credentials(token="bench"),
+        download_workers=workers,
+        upload_workers=workers,
+        list_workers=workers,
+    )
+
+
+def add_local_files(root_path, files, seed):
+    new_root = root_path / "bench_new"
+    new_root.mkdir()
+    for kind, path, content in generate(files, seed=seed):
+        if kind == "folder":
+            (new_root / path).mkdir()
+        else:
+            (new_root / path).write_bytes(content)
+
+
+def run(args):
+    fake = FakeDrive(latency=args.latency, error_rate=args.error_rate).start()
+    scenarios = {}
+    try:
+        drive = open_drive(fake, args.workers)
+        root_id = fake.state.create({"name": "bench", "mimeType": FOLDER})["id"]
+        make_cloud_tree(
+            fake.state,
+            root_id,
+            args.files,
+            fanout=args.fanout,
+            files_per_folder=args.files_per_folder,
+            size=args.size,
+            duplicates=args.duplicates,
+        )
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root_path = Path(temp_dir) / "root"
+            root_path.mkdir()
+            db_path = Path(temp_dir) / "bench.db"
+            ctx = {
+                "root_id": root_id,
+                "root_path": root_path,
+                "status": {},
+                "hash_cache": HashCache(db_path),
+                "snapshot": CloudSnapshot(db_path),
+                "upload_sessions": UploadSessions(db_path),
+                "download_sessions": DownloadSessions(db_path),
+                "state": SyncState(db_path),
+            }
+
+            def scenario(name):
+                fake.calls.clear()
+                drive.metrics = Metrics()
+                start = time.perf_counter()
+                drive.sync(**ctx)
+                total = time.perf_counter() - start
+                drive.metrics.finish()
+                report = drive.metrics.report()
+                phases = dict(report["phases"], total=total)
+                scenarios[name] = {
+                    "seconds": {k: round(v, 4) for k, v in phases.items()},
+                    "counters": report["counters"],
+                    "api_calls": dict(fake.calls),
+                }
+                print(f"{name:<18}" + format_phases(phases))
+
+            scenario("initial_download")
+            scenario("noop_resync")
+            add_local_files(root_path, max(args.files // 10, 1), args.seed + 1)
+            scenario("local_upload")
+
+            stores = ["hash_cache", "snapshot", "upload_sessions", "download_sessions"]
+            for key in stores + ["state"]:
+                ctx[key].close()
+    finally:
+        fake.stop()
+    return scenarios
+
+
+def format_phases(phases):
+    return " ".join(f"{k}={v:.3f}s" for k, v in phases.items())
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_results():
+    if not results_path.exists():
+        return []
+    with results_path.open() as f:
+        return [json.loads(x) for x in f if x.strip()]
+
+
+def compare(results):
+    # Latest run of the two most recent commits, matched on the same arguments
+    latest = {}
+    for result in results:
+        latest.pop(result["commit"], None)
+        latest[result["commit"]] = result
+    if len(latest) < 2:
+        print("Need results from two commits to compare")
+        return
+    old, new = list(latest.values())[-2:]
+    if old["args"] != new["args"]:
+        print("Warning: the runs used different arguments")
+    print(f"{old['commit']} -> {new['commit']}")
+    for name, scenario in new["scenarios"].items():
+        if name not in old["scenarios"]:
+            continue
+        print(name)
+        before = old["scenarios"][name]["seconds"]
+        for phase, seconds in scenario["seconds"].items():
+            if phase not in before:
+                continue
+            delta = (seconds - before[phase]) / before[phase] if before[phase] else 0
+            print(f"  {phase:<14} {before[phase]:9.3f}s {seconds:9.3f}s {delta:+8.1%}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark sync against a fake Drive")
+    parser.add_argument("--files", type=int, default=1000, help="files in the tree")
+    parser.add_argument("--fanout", type=int, default=8, help="subfolders per folder")
+    parser.add_argument(
+        "--files-per-folder", type=int, default=32, help="files in each folder"
+    )
+    parser.add_argument("--size", type=int, default=1024, help="average file size")
+    parser.add_argument(
+        "--duplicates",
+        type=float,
+        default=0.0,
+        help="fraction of files repeating earlier content",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to every request"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="fraction of requests failing with a rate limit error",
+    )
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument(
+        "--no-save", action="store_true", help="do not record the results"
+    )
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="compare the latest results of the two most recent commits",
+    )
+    parser.add_argument("--verbose", action="store_true", help="show sync logs")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        compare(load_results())
+        return
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    scenarios = run(args)
+    if not args.no_save:
+        result = {
+            "commit": git_commit(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "args": {
+                k: v
+                for k, v in vars(args).items()
+                if k not in ("no_save", "compare", "verbose")
+            },
+            "scenarios": scenarios,
+        }
+        with results_path.open("a") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import random
+from pathlib import Path
+
+from bench.fake_drive import FOLDER
+
+
+def generate(files, fanout=8, files_per_folder=32, size=1024, seed=0, duplicates=0.0):
+    # Deterministic layout: yields ("folder", path, None) and
+    # ("file", path, content) with parents always before their children
+    rng = random.Random(seed)
+    folders = [Path()]
+    next_folder = 0
+    made = 0
+    contents = []
+    while made < files:
+        parent = folders[next_folder]
+        next_folder += 1
+        for _ in range(fanout):
+            folder = parent / f"dir_{len(folders):06d}"
+            folders.append(folder)
+            yield "folder", folder, None
+        for _ in range(min(files_per_folder, files - made)):
+            if contents and rng.random() < duplicates:
+                content = rng.choice(contents)
+            else:
+                content = rng.randbytes(rng.randint(size // 2, size * 3 // 2))
+                if len(contents) < 1000:
+                    contents.append(content)
+            yield "file", parent / f"file_{made:07d}.bin", content
+            made += 1
+
+
+def make_local_tree(root_path, files, **kwargs):
+    root_path = Path(root_path)
+    root_path.mkdir(parents=True, exist_ok=True)
+    for kind, path, content in generate(files, **kwargs):
+        if kind == "folder":
+            (root_path / path).mkdir(exist_ok=True)
+        else:
+            (root_path / path).write_bytes(content)
+    return root_path
+
+
+def make_cloud_tree(state, root_id, files, **kwargs):
+    # Writes straight into the fake service state instead of going through HTTP
+    ids = {Path(): root_id}
+    for kind, path, content in generate(files, **kwargs):
+        meta = {"name": path.name, "parents": [ids[path.parent]]}
+        if kind == "folder":
+            meta["mimeType"] = FOLDER
+        ids[path] = state.create(meta, content)["id"]
+    return ids
@@ -0,0 +1,248 @@
+import os
+import sys
+from datetime import datetime
+
+from moves import find_cloud_moves, find_local_moves
+
+google_types = ("gdsheet", "gddoc")
+
+
+def parse_time(value):
+    if value is None:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def parents(path):
+    while True:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return
+        yield parent
+        path = parent
+
+
+def ancestors(paths):
+    found = set()
+    for path in paths:
+        for parent in parents(path):
+            if parent in found:
+                break
+            found.add(parent)
+    return found
+
+
+def under_paths(path, paths):
+    return path in paths or any(x in paths for x in parents(path))
+
+
+def same_content(a, b):
+    # Sizes are known on every side without reading the file, so a mismatch
+    # settles it before the md5s are compared
+    if a.size is not None and b.size is not None and a.size != b.size:
+        return False
+    return a.md5 == b.md5
+
+
+class CloudFile:
+    __slots__ = (
+        "id",
+        "name",
+        "type",
+        "modified",
+        "size",
+        "md5",
+        "url",
+        "path",
+        "parent",
+    )
+
+    def __init__(self, file_id, name, file_type, modified, size, md5, url, parents):
+        self.id = file_id
+        self.name = name
+        self.type = file_type
+        self.modified = modified
+        self.size = size
+        self.md5 = md5
+        self.url = url
+        self.path = None
+        # The listed parents, until the tree is built and one is picked
+        self.parent = parents
+
+    @property
+    def local_name(self):
+        if self.type in google_types:
+            return f"{self.name}.{self.type}"
+        return self.name
+
+    @property
+    def mtime(self):
+        # Parsed on demand, most files never need it
+        return parse_time(self.modified)
+
+
+class Entry:
+    # One path joined across the cloud listing, the local scan and the state
+    # from the last sync. id and parent start from the cloud side and change
+    # as the path gets uploaded or moved, stat is the local file's as the
+    # download or move left it
+    __slots__ = ("path", "cloud", "local", "base", "id", "parent", "name", "stat")
+
+    def __init__(self, path):
+        self.path = path
+        self.cloud = self.local = self.base = None
+        self.id = self.parent = self.name = self.stat = None
+
+
+class Changes:
+    def __init__(self):
+        self.unchanged = 0
+        self.only_base = []
+        self.entries = []
+        self.download = []
+        self.update_local = []
+        self.upload = []
+        self.update_cloud = []
+        self.delete_local = []
+        self.delete_cloud = []
+        self.local_moves = []
+        self.cloud_moves = []
+        self.moved_up = []
+        self.moved_down = []
+        self.moved_from = []
+
+
+def join(cloud_files, local_files, base_rows):
+    # Hashed join on the path; paths are interned so every side of an entry
+    # shares one string
+    entries = {}
+    duplicates = 0
+    for cloud in cloud_files:
+        path = sys.intern(cloud.path)
+        if path in entries:
+            duplicates += 1
+            continue
+        entry = entries[path] = Entry(path)
+        entry.cloud = cloud
+        entry.id = cloud.id
+        entry.parent = cloud.parent
+    for local in local_files:
+        path = sys.intern(local.path)
+        entry = entries.get(path)
+        if entry is None:
+            entry = entries[path] = Entry(path)
+        entry.local = local
+    for base in base_rows:
+        path = sys.intern(base.path)
+        entry = entries.get(path)
+        if entry is None:
+            entry = entries[path] = Entry(path)
+        entry.base = base
+    return entries, duplicates
+
+
+def classify(entries, track_moves=False):
+    changes = Changes()
+    for entry in entries.values():
+        cloud, local, base = entry.cloud, entry.local, entry.base
+        # Folders and Google docs have no content to compare, only presence
+        has_content = (
+            local is not None
+            and local.type != "folder"
+            and local.type not in google_types
+        )
+        local_changed = (
+            base is not None and has_content and not same_content(local, base)
+        )
+        cloud_changed = (
+            base is not None
+            and cloud is not None
+            and (
+                cloud.id != base.id
+                or (cloud.md5 is not None and cloud.md5 != base.md5)
+            )
+        )
+
+        # Entries that match their base on both sides need no further work
+        if base is not None and local is None and cloud is None:
+            changes.only_base.append(entry.path)
+            continue
+        if (
+            base is not None
+            and local is not None
+            and cloud is not None
+            and not local_changed
+            and not cloud_changed
+        ):
+            changes.unchanged += 1
+            continue
+        changes.entries.append(entry)
+
+        if local is None:
+            if base is None or cloud_changed:
+                changes.download.append(entry)
+            else:
+                changes.delete_cloud.append(entry)
+        elif cloud is None:
+            name = os.path.basename(entry.path)
+            if local.type in google_types:
+                name = os.path.splitext(name)[0]
+            entry.name = name
+            if base is None or local_changed:
+                changes.upload.append(entry)
+            else:
+                changes.delete_local.append(entry)
+        elif (
+            has_content
+            and cloud.type not in google_types
+            and not same_content(local, cloud)
+        ):
+            # Only one side changed since the last sync, it wins; otherwise
+            # the newer copy does
+            cloud_mtime = cloud.mtime
+            newer_cloud = cloud_mtime is not None and cloud_mtime > local.mtime
+            newer_local = cloud_mtime is not None and cloud_mtime < local.mtime
+            same = cloud_changed == local_changed
+            if (cloud_changed and not local_changed) or (same and newer_cloud):
+                changes.update_local.append(entry)
+            elif (local_changed and not cloud_changed) or (same and newer_local):
+                changes.update_cloud.append(entry)
+
+    # A folder deleted on one side stays if the other side changed something
+    # inside it
+    keep = ancestors(x.path for x in changes.download)
+    changes.download += [x for x in changes.delete_cloud if x.path in keep]
+    changes.delete_cloud = [x for x in changes.delete_cloud if x.path not in keep]
+    keep = ancestors(x.path for x in changes.upload)
+    changes.upload += [x for x in changes.delete_local if x.path in keep]
+    changes.delete_local = [x for x in changes.delete_local if x.path not in keep]
+
+    if track_moves:
+        # Renames show up as a delete plus a new path, match them back up
+        changes.local_moves, covered = find_local_moves(
+            changes.delete_cloud, changes.upload
+        )
+        for old, new in covered.items():
+            old, new = entries[str(old)], entries[str(new)]
+            new.id = old.id
+            changes.moved_up.append(new)
+            changes.moved_from.append(old)
+
+        changes.cloud_moves, covered = find_cloud_moves(
+            changes.delete_local, changes.download
+        )
+        for old, new in covered.items():
+            old, new = entries[str(old)], entries[str(new)]
+            changes.moved_down.append(new)
+            changes.moved_from.append(old)
+            # Moves are matched on the id, the content may have changed too.
+            # Fetching it after the rename keeps the state from recording a
+            # cloud md5 the local copy does not have
+            if new.cloud.md5 is not None and new.cloud.md5 != old.base.md5:
+                changes.update_local.append(new)
+
+        moved = set(changes.moved_up + changes.moved_down + changes.moved_from)
+        for name in ["upload", "download", "delete_cloud", "delete_local"]:
+            kept = [x for x in getattr(changes, name) if x not in moved]
+            setattr(changes, name, kept)
+    return changes
@@ -0,0 +1,141 @@
+import fnmatch
+import hashlib
+import mimetypes
+import os
+import re
+
+# Local files standing in for Google docs, by extension
+link_types = {
+    "gdsheet": "application/vnd.google-apps.spreadsheet",
+    "gddoc": "application/vnd.google-apps.document",
+}
+google_prefix = "application/vnd.google-apps."
+folder_type = "application/vnd.google-apps.folder"
+
+
+def glob_to_regex(pattern):
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and pattern.find("]", i + 2) != -1:
+            end = pattern.find("]", i + 2)
+            chars = pattern[i + 1 : end].replace("\\", "\\\\")
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            parts.append(f"[{chars}]")
+            i = end + 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(parts)
+
+
+def compile_rule(line):
+    line = line.rstrip()
+    if not line or line.startswith("#"):
+        return None
+    negate = line.startswith("!")
+    if negate:
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    # Like gitignore, a slash before the end ties the pattern to the root,
+    # otherwise it matches the name at any depth
+    anchored = "/" in line
+    regex = glob_to_regex(line.lstrip("/"))
+    if not anchored:
+        regex = "(?:.*/)?" + regex
+    return re.compile(regex), negate, dir_only
+
+
+def name_type(name):
+    extension = os.path.splitext(name)[1].strip(".")
+    if extension in link_types:
+        return link_types[extension]
+    return mimetypes.guess_type(name)[0]
+
+
+class IgnoreRules:
+    def __init__(
+        self, root_path, exclude=(), include=(), exclude_types=(), max_size=None
+    ):
+        # Gitignore semantics: the last matching pattern wins and nothing
+        # inside an excluded folder comes back. Includes act as "!" patterns
+        # after the excludes, and win over the type filter too
+        lines = list(exclude) + [f"!{x}" for x in include]
+        self.lines = lines
+        self.root = str(root_path)
+        self.rules = [x for x in map(compile_rule, lines) if x is not None]
+        self.exclude_types = list(exclude_types)
+        self.max_size = max_size
+
+    @classmethod
+    def from_config(cls, root_path, config):
+        return cls(
+            root_path,
+            config.get("exclude", ()),
+            config.get("include", ()),
+            config.get("exclude_types", ()),
+            config.get("max_file_size"),
+        )
+
+    def __bool__(self):
+        return bool(self.rules or self.exclude_types or self.max_size is not None)
+
+    def digest(self):
+        # Changes with the patterns, which decide what folders get listed
+        return hashlib.md5("\n".join(self.lines).encode()).hexdigest()
+
+    def relative(self, path):
+        path = str(path)
+        if path.startswith(self.root + os.sep):
+            path = path[len(self.root) + 1 :]
+        else:
+            path = os.path.relpath(path, self.root)
+        return path.replace(os.sep, "/")
+
+    def excluded_type(self, mime):
+        return mime is not None and any(
+            fnmatch.fnmatchcase(mime, x) for x in self.exclude_types
+        )
+
+    def ignored(self, path, is_dir=False):
+        # Types come from the name, so both sides agree on every path
+        relative = self.relative(path)
+        for regex, negate, dir_only in reversed(self.rules):
+            if (is_dir or not dir_only) and regex.fullmatch(relative):
+                return not negate
+        return not is_dir and self.excluded_type(name_type(relative))
+
+    def ignored_tree(self, path, is_dir=False):
+        # For paths reached without walking down from the root
+        relative = self.relative(path)
+        parts = relative.split("/")
+        for i in range(1, len(parts)):
+            if self.ignored(os.path.join(self.root, *parts[:i]), True):
+                return True
+        return self.ignored(path, is_dir)
+
+    def ignored_cloud_type(self, mime):
+        # Google types without a local file have no name to go by
+        return (
+            mime != folder_type
+            and mime.startswith(google_prefix)
+            and mime not in link_types.values()
+            and self.excluded_type(mime)
+        )
+
+    def too_large(self, size):
+        return self.max_size is not None and size is not None and size > self.max_size
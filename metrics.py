@@ -0,0 +1,135 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+# Transfer counters and the timer counter their throughput is computed from
+throughputs = {
+    "download": ("bytes_downloaded", "download_seconds"),
+    "upload": ("bytes_uploaded", "upload_seconds"),
+    "hash": ("bytes_hashed", "hash_seconds"),
+}
+
+
+class Metrics:
+    def __init__(self, profile_path=None, profile_phases=("classify",)):
+        # Counters are updated from worker threads, phases only from the
+        # thread running the sync
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.api_calls = Counter()
+        self.phases = Counter()
+        self.started_at = datetime.now()
+        self.start = time.monotonic()
+        self.current = None
+        self.phase_start = None
+        self.profile_path = profile_path
+        self.profile_phases = set(profile_phases)
+        self.profiler = cProfile.Profile() if profile_path else None
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def count_call(self, method, value=1):
+        with self.lock:
+            self.api_calls[method] += value
+
+    def phase(self, name):
+        # Ends the running phase and starts the next one, so a long function
+        # can be split into phases without nesting it in blocks
+        now = time.monotonic()
+        if self.current is not None:
+            self.phases[self.current] += now - self.phase_start
+            if self.profiler is not None and self.current in self.profile_phases:
+                self.profiler.disable()
+        self.current, self.phase_start = name, now
+        if self.profiler is not None and name in self.profile_phases:
+            self.profiler.enable()
+
+    def finish(self):
+        self.phase(None)
+        if self.profiler is not None:
+            self.profiler.dump_stats(str(self.profile_path))
+
+    def report(self):
+        with self.lock:
+            counters = dict(self.counters)
+            api_calls = dict(self.api_calls)
+        rates = {}
+        for name, (size, seconds) in throughputs.items():
+            if counters.get(seconds):
+                rates[name] = counters.get(size, 0) / counters[seconds] / 2**20
+        return {
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "duration": time.monotonic() - self.start,
+            "phases": dict(self.phases),
+            "api_calls": api_calls,
+            "counters": counters,
+            "throughput_mib_s": rates,
+        }
+
+    def write_report(self, path, **extra):
+        report = {**extra, **self.report()}
+        write_atomic(path, json.dumps(report, indent=2) + "\n")
+
+    def write_prometheus(self, path, **labels):
+        report = self.report()
+        base = ",".join(f'{k}="{v}"' for k, v in labels.items())
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP drive_sync_{name} {help_text}")
+            lines.append(f"# TYPE drive_sync_{name} {kind}")
+            for extra, value in samples:
+                label_text = ",".join(x for x in (base, extra) if x)
+                if label_text:
+                    label_text = f"{{{label_text}}}"
+                lines.append(f"drive_sync_{name}{label_text} {value}")
+
+        metric(
+            "last_run_timestamp_seconds",
+            "gauge",
+            "Start of the last run.",
+            [("", self.started_at.timestamp())],
+        )
+        metric(
+            "duration_seconds",
+            "gauge",
+            "Wall time of the last run.",
+            [("", report["duration"])],
+        )
+        metric(
+            "phase_seconds",
+            "gauge",
+            "Wall time per phase of the last run.",
+            [(f'phase="{k}"', v) for k, v in report["phases"].items()],
+        )
+        metric(
+            "api_calls",
+            "gauge",
+            "API calls made in the last run by method.",
+            [(f'method="{k}"', v) for k, v in report["api_calls"].items()],
+        )
+        for name, value in sorted(report["counters"].items()):
+            help_text = f"{name.replace('_', ' ').capitalize()} in the last run."
+            metric(name, "gauge", help_text, [("", value)])
+        metric(
+            "throughput_mib_per_second",
+            "gauge",
+            "Transfer and hashing throughput of the last run.",
+            [(f'kind="{k}"', v) for k, v in report["throughput_mib_s"].items()],
+        )
+        write_atomic(path, "\n".join(lines) + "\n")
+
+
+def write_atomic(path, text):
+    # The textfile collector may read at any time, so never expose a half
+    # written file
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
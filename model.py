@@ -1,51 +1,95 @@
 import json
+import mimetypes
 import os
 import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import nullcontext
 from datetime import datetime
 from enum import Enum
+from functools import partial
 from pathlib import Path
 
-import pandas as pd
-import yaml
-from googleapiclient.discovery import MediaFileUpload, build
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest, MediaIoBaseDownload, MediaIoBaseUpload
 
-from utils import get_logger, get_md5
+from diff import (
+    CloudFile,
+    Entry,
+    ancestors,
+    classify,
+    google_types,
+    join,
+    under_paths,
+)
+from metrics import Metrics
+from plan import Plan
+from scheduler import Scheduler, is_quota_error, is_retryable
+from scan import scan_paths, scan_tree
+from transfers import TransferPolicy
+from utils import (
+    HashingReader,
+    HashingWriter,
+    copy_file,
+    get_logger,
+    md5_file,
+    partial_suffix,
+    thread_pool,
+)
 
 log = get_logger(__file__)
 
 
-def get_local_df(root_path):
-    file_list = []
-    for root, dirs, files in os.walk(root_path):
-        root = Path(root)
-        for x in dirs:
-            path = root / x
-            file_list.append(
-                {
-                    "local_type": "folder",
-                    "local_path": path,
-                    "local_mtime": path.stat().st_mtime,
-                }
-            )
-        for x in files:
-            path = root / x
-            file_list.append(
-                {
-                    "local_type": path.suffix.strip("."),
-                    "local_path": path,
-                    "local_mtime": max(path.stat().st_mtime, path.stat().st_ctime),
-                    "local_md5": get_md5(path),
-                }
-            )
-    return pd.DataFrame(file_list)
+def get_local_files(
+    root_path,
+    hash_cache=None,
+    paths=None,
+    metrics=None,
+    known=None,
+    strict=False,
+    rules=None,
+    defer=None,
+):
+    if paths is None:
+        return scan_tree(
+            root_path,
+            hash_cache,
+            metrics=metrics,
+            known=known,
+            strict=strict,
+            rules=rules,
+            defer=defer,
+        )
+    paths = [Path(x) for x in paths]
+    return scan_paths(paths, hash_cache, metrics, known, strict, rules, defer)
 
 
-def delete_path(path):
-    if path.is_dir():
-        shutil.rmtree(path)
-    elif path.exists():
-        path.unlink()
+def delete_path(path, rules=None):
+    # Ignored and too large files exist only locally, a folder keeps them and
+    # stays as long as any are left
+    if rules is None or not path.is_dir() or path.is_symlink():
+        if path.is_symlink():
+            path.unlink()
+        elif path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
+        return
+    for child in path.iterdir():
+        is_dir = child.is_dir() and not child.is_symlink()
+        if rules.ignored(child, is_dir):
+            continue
+        if not is_dir and rules.too_large(child.lstat().st_size):
+            continue
+        delete_path(child, rules)
+    try:
+        path.rmdir()
+    except OSError:
+        log.info(f"Keeping `{path}`, it holds ignored files")
 
 
 class MimeType(Enum):
@@ -66,6 +110,40 @@ mime_types = {
 }
 
 
+def build_tree(root_id, root_path, files, rules=None, hidden=None):
+    # Children in id order, so ties between parents at the same depth go the
+    # same way whatever order the listing came back in. hidden gets the ids
+    # of folders holding ignored files
+    children = {}
+    for file in sorted(files, key=lambda x: x.id):
+        if not isinstance(file.parent, list):
+            continue
+        for parent in file.parent:
+            children.setdefault(parent, []).append(file)
+
+    # Breadth first from the root, so an item with several parents is placed
+    # under the shallowest one and anything unreachable is left out
+    placed = []
+    queue = deque([(root_id, str(root_path))])
+    while queue:
+        base_id, base_path = queue.popleft()
+        for file in children.get(base_id, ()):
+            if file.path is not None:
+                continue
+            path = os.path.join(base_path, file.local_name)
+            # Ignored folders are not descended, their contents stay unplaced
+            if rules is not None and rules.ignored(path, file.type == "folder"):
+                if hidden is not None:
+                    hidden.add(base_id)
+                continue
+            file.path = path
+            file.parent = base_id
+            placed.append(file)
+            if file.type == "folder":
+                queue.append((file.id, file.path))
+    return placed
+
+
 def get_mime(value):
     for k, v in mime_types.items():
         if v == value:
@@ -79,28 +157,144 @@ def mime_mapper(value):
     return "unknown"
 
 
+class ScheduledRequest(HttpRequest):
+    # Sends every call made through the client through the account's
+    # scheduler. Batched calls never execute on their own, execute_batch
+    # schedules the batch instead
+    drive = None
+
+    def execute(self, *args, **kwargs):
+        if self.resumable is not None:
+            # Resumable uploads are sent chunk by chunk through next_chunk
+            return super().execute(*args, **kwargs)
+        return self.drive.schedule(
+            self.methodId, partial(super().execute, *args, **kwargs)
+        )
+
+    def next_chunk(self, *args, **kwargs):
+        return self.drive.schedule(
+            self.methodId, partial(super().next_chunk, *args, **kwargs)
+        )
+
+
 class GoogleDrive:
-    google_mimes = ["gdsheet", "gddoc"]
+    # Drive rejects batches with more than 100 calls
+    batch_size = 100
+    # Semaphore shared by all accounts to cap concurrent network requests
+    request_slots = None
+    # Discovery document to build services from instead of the bundled one
+    discovery_doc = None
+    google_mimes = google_types
     link_mimes = [MimeType.GDSHEET, MimeType.GDDOC]
     non_md5_mimes = link_mimes + [MimeType.FOLDER]
+    file_fields = (
+        "id, name, modifiedTime, mimeType, parents, size, md5Checksum, webViewLink"
+    )
+    # Parents are implied by the folder being listed
+    list_fields = "id, name, modifiedTime, mimeType, size, md5Checksum, webViewLink"
 
-    def __init__(self, creds):
-        self.service = build("drive", "v3", credentials=creds)
-        self.email_address = (
-            self.service.about()  # pylint: disable=no-member
-            .get(fields="user(emailAddress)")
-            .execute()["user"]["emailAddress"]
-        )
+    def __init__(
+        self,
+        creds,
+        download_workers=8,
+        upload_workers=4,
+        list_workers=8,
+        chunk_size=10 * 1024 * 1024,
+        requests_per_second=200,
+        max_concurrency=32,
+        email_address=None,
+        started=None,
+        transfers=None,
+    ):
+        self.creds = creds
+        self.list_workers = list_workers
+        self.download_workers = download_workers
+        self.upload_workers = upload_workers
+        self.chunk_size = chunk_size
+        self.transfers = transfers or TransferPolicy()
+        self._local = threading.local()
+        self._owner = threading.current_thread()
+        self.metrics = Metrics()
+        self.scheduler = Scheduler(requests_per_second, max_concurrency)
+        # Fetched on first use unless the caller already knows it
+        self._email_address = email_address
+        self.started = time.monotonic() if started is None else started
+        self.first_call = None
 
+        self.service = self.build_service()
         self.files = self.service.files()  # pylint: disable=no-member
+        self.changes = self.service.changes()  # pylint: disable=no-member
+
+    @property
+    def email_address(self):
+        if self._email_address is None:
+            self._email_address = (
+                self.service.about()  # pylint: disable=no-member
+                .get(fields="user(emailAddress)")
+                .execute()["user"]["emailAddress"]
+            )
+        return self._email_address
+
+    def build_service(self):
+        # Reading the discovery document costs more than building the service
+        # from it, so the one bundled with the client is parsed once per
+        # process
+        doc = GoogleDrive.discovery_doc
+        if doc is None:
+            doc = get_static_doc("drive", "v3")
+        if isinstance(doc, str):
+            doc = json.loads(doc)
+        GoogleDrive.discovery_doc = doc
+        return build_from_document(
+            doc, credentials=self.creds, requestBuilder=self.build_request
+        )
+
+    def build_request(self, *args, **kwargs):
+        request = ScheduledRequest(*args, **kwargs)
+        request.drive = self
+        return request
+
+    def schedule(self, method, func, tokens=1):
+        def counted():
+            if self.first_call is None:
+                self.first_call = time.monotonic() - self.started
+                self.metrics.count("time_to_first_call_seconds", self.first_call)
+                log.info(f"First API call {self.first_call:.2f}s after starting")
+            self.metrics.count_call(method)
+            return func()
+
+        return self.scheduler.call(counted, tokens=tokens, metrics=self.metrics)
+
+    def thread_service(self):
+        # httplib2 is not thread-safe, so every worker gets its own service
+        if threading.current_thread() is self._owner:
+            return self.service
+        if not hasattr(self._local, "service"):
+            self._local.service = self.build_service()
+            self._local.files = self._local.service.files()  # pylint: disable=no-member
+        return self._local.service
+
+    def thread_files(self):
+        if threading.current_thread() is self._owner:
+            return self.files
+        self.thread_service()
+        return self._local.files
+
+    @classmethod
+    def set_request_limit(cls, limit):
+        cls.request_slots = threading.BoundedSemaphore(limit) if limit else None
+
+    def in_slot(self, func, *args):
+        slots = GoogleDrive.request_slots
+        with nullcontext() if slots is None else slots:
+            return func(*args)
 
     def _list_files(self, query):
         page_token = None
         file_list = []
 
         query = " ".join([x.strip() for x in query.strip().split("\n")])
-        cols = "id, name, modifiedTime, mimeType, parents, md5Checksum, webViewLink"
-        fields = f"nextPageToken, files({cols})"
+        fields = f"nextPageToken, files({GoogleDrive.file_fields})"
         while True:
             resp = self.files.list(
                 spaces="drive", fields=fields, pageToken=page_token, q=query,
@@ -116,232 +310,1112 @@ class GoogleDrive:
         query = "('me' in owners) and (trashed=false)"
         return self._list_files(query)
 
-    def list_files(self, root_id):
-        query = "('me' in owners) and (trashed=false)"
-        return self._list_files(query)
+    def _list_folder_page(self, folder_id, page_token):
+        query = f"('{folder_id}' in parents) and ('me' in owners) and (trashed=false)"
+        resp = (
+            self.thread_files()
+            .list(
+                spaces="drive",
+                fields=f"nextPageToken, files({GoogleDrive.list_fields})",
+                pageToken=page_token,
+                pageSize=1000,
+                q=query,
+            )
+            .execute()
+        )
+        return folder_id, resp.get("files", []), resp.get("nextPageToken")
 
-    def get_root(self):
-        return self.files.get(fileId="root").execute()
+    def list_files(self, root_id, rules=None, root_path=None):
+        # Walks the tree under root_id with one query per folder, yielding
+        # each page as it arrives instead of collecting the whole listing.
+        # Ignored folders are listed, marked unlisted, but never descended.
+        # An item found in several folders comes again each time, with every
+        # parent so far. Only the parents of each id are kept, not the files.
+        # root_path is where root_id is locally, the root of the rules if not
+        # given
+        parents = {}
+        if root_path is None and rules is not None:
+            root_path = rules.root
+        folder_paths = {root_id: root_path}
+        with thread_pool(self.list_workers) as pool:
 
-    def get_cloud_df(self, root_id, root_path):
-        file_list = self.list_files(root_id)
-        df = pd.DataFrame(file_list)
-        df = df.set_index("id")
-        df = df.rename(
-            columns={
-                "mimeType": "mime_type",
-                "parents": "parent",
-                "webViewLink": "url",
-                "modifiedTime": "cloud_mtime",
-                "md5Checksum": "cloud_md5",
-                "name": "cloud_name",
-            }
-        )
-        df["parent"] = df["parent"].apply(lambda x: x[0])
-        df["cloud_mtime"] = pd.to_datetime(df["cloud_mtime"]).apply(
-            lambda x: x.timestamp()
+            def submit(folder_id, page_token=None):
+                return pool.submit(
+                    self.in_slot, self._list_folder_page, folder_id, page_token
+                )
+
+            pending = {submit(root_id)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    folder_id, files, page_token = future.result()
+                    if page_token is not None:
+                        pending.add(submit(folder_id, page_token))
+                    page = []
+                    for file in files:
+                        repeated = file["id"] in parents
+                        file["parents"] = parents.setdefault(file["id"], [])
+                        file["parents"].append(folder_id)
+                        page.append(file)
+                        if repeated:
+                            continue
+                        if file["mimeType"] == MimeType.FOLDER.value:
+                            if rules is not None:
+                                path = os.path.join(
+                                    folder_paths[folder_id], file["name"]
+                                )
+                                if rules.ignored(path, True):
+                                    file["unlisted"] = True
+                                    continue
+                                folder_paths[file["id"]] = path
+                            pending.add(submit(file["id"]))
+                    yield page
+
+    def get_start_page_token(self):
+        return self.changes.getStartPageToken().execute()["startPageToken"]
+
+    @staticmethod
+    def in_tree(file, root_id, snapshot):
+        # Follows the parents through the snapshot up to the root
+        seen = set()
+        pending = [file] if file is not None else []
+        while pending:
+            file = pending.pop()
+            for parent in file.get("parents") or ():
+                if parent == root_id:
+                    return True
+                if parent not in seen:
+                    seen.add(parent)
+                    parent = snapshot.get(parent)
+                    if parent is not None:
+                        pending.append(parent)
+        return False
+
+    @staticmethod
+    def snapshot_path(file, root_id, root_path, snapshot):
+        # Local path of a file under the root, through its first parents
+        names = []
+        while file is not None:
+            names.append(file["name"])
+            parents = file.get("parents") or ()
+            if root_id in parents:
+                return os.path.join(root_path, *reversed(names))
+            file = snapshot.get(parents[0]) if parents else None
+        return None
+
+    def apply_changes(self, page_token, snapshot, root_id, changed=None, rules=None):
+        # The feed covers the whole account, the snapshot only keeps what is
+        # under the root. A folder moved under the root from elsewhere
+        # arrives without its contents, and so does an ignored folder a move
+        # or rename takes out of the rules; those get listed once the whole
+        # feed is in. changed gets the id and the new file of every change,
+        # None for removed ones
+        cols = f"{GoogleDrive.file_fields}, trashed, ownedByMe"
+        changes = f"changes(fileId, removed, file({cols}))"
+        fields = f"nextPageToken, newStartPageToken, {changes}"
+        count = 0
+        entered = []
+        left = moved = False
+        while True:
+            resp = self.changes.list(
+                spaces="drive", fields=fields, pageToken=page_token, pageSize=1000,
+            ).execute()
+            for change in resp.get("changes", []):
+                file = change.get("file")
+                if change.get("removed") or file is None:
+                    snapshot.remove(change["fileId"])
+                    file = None
+                elif file.pop("trashed", False) or not file.pop("ownedByMe", True):
+                    snapshot.remove(file["id"])
+                    file = None
+                elif self.in_tree(file, root_id, snapshot):
+                    old = snapshot.get(file["id"])
+                    folder = file["mimeType"] == MimeType.FOLDER.value
+                    if folder and not self.in_tree(old, root_id, snapshot):
+                        entered.append(file["id"])
+                    elif folder:
+                        if old.get("unlisted"):
+                            file["unlisted"] = True
+                        moved = moved or (old["name"], old.get("parents")) != (
+                            file["name"],
+                            file.get("parents"),
+                        )
+                    snapshot.put(file)
+                else:
+                    # Moved out of the root, or never under it
+                    left = left or snapshot.get(file["id"]) is not None
+                    snapshot.remove(file["id"])
+                if changed is not None:
+                    changed.append((change["fileId"], file))
+                count += 1
+            if "newStartPageToken" in resp:
+                page_token = resp["newStartPageToken"]
+                break
+            page_token = resp["nextPageToken"]
+
+        if left:
+            self.prune_snapshot(root_id, snapshot)
+        if moved and rules is not None:
+            entered.extend(
+                x["id"] for page in snapshot.pages() for x in page if x.get("unlisted")
+            )
+        listed = set()
+        for folder_id in entered:
+            folder = snapshot.get(folder_id)
+            if folder_id in listed or not self.in_tree(folder, root_id, snapshot):
+                continue
+            path = None
+            if rules is not None:
+                path = self.snapshot_path(folder, root_id, rules.root, snapshot)
+                if rules.ignored_tree(path, True):
+                    if not folder.get("unlisted"):
+                        folder["unlisted"] = True
+                        snapshot.put(folder)
+                    continue
+                if folder.pop("unlisted", False):
+                    snapshot.put(folder)
+            for page in self.list_files(folder_id, rules, path):
+                for file in page:
+                    snapshot.put(file)
+                    listed.add(file["id"])
+        snapshot.commit()
+        if count:
+            log.info(f"Applied {count} changes from the cloud")
+        return page_token
+
+    @staticmethod
+    def prune_snapshot(root_id, snapshot):
+        # Drops what is no longer reachable from the root, like the contents
+        # of a folder that moved out of it
+        children = {}
+        ids = set()
+        for page in snapshot.pages():
+            for file in page:
+                ids.add(file["id"])
+                for parent in file.get("parents") or ():
+                    children.setdefault(parent, []).append(file["id"])
+        queue = [root_id]
+        reachable = set()
+        while queue:
+            for child in children.get(queue.pop(), ()):
+                if child not in reachable:
+                    reachable.add(child)
+                    queue.append(child)
+        for file_id in ids - reachable:
+            snapshot.remove(file_id)
+
+    @classmethod
+    def synced(cls, file_id, file, root_id, root_path, snapshot, state):
+        # Whether a change needs no pass: it shows what the state already
+        # records, like the uploads, moves and deletes of the last pass, or
+        # it is outside the root
+        row = state.by_id(file_id)
+        if file is None:
+            return row is None
+        if row is None:
+            return not cls.in_tree(file, root_id, snapshot)
+        md5 = file.get("md5Checksum")
+        if md5 is not None and md5 != row.md5:
+            return False
+        name = os.path.basename(row.path)
+        if mime_mapper(file["mimeType"]) in google_types:
+            name = os.path.splitext(name)[0]
+        folder = os.path.dirname(row.path)
+        if folder == str(root_path):
+            parent = root_id
+        else:
+            parent = state.get(folder)
+            parent = parent.id if parent is not None else None
+        return file["name"] == name and parent in (file.get("parents") or ())
+
+    def poll_changes(
+        self, root_id, root_path, status, snapshot, state, rules=None, paths=None
+    ):
+        # Takes in what changed since the last pass and tells whether any of
+        # it needs a pass. The snapshot keeps the changes either way. Before
+        # a partial pass over paths, only changes elsewhere count
+        changed = []
+        status["page_token"] = self.apply_changes(
+            status["page_token"], snapshot, root_id, changed, rules
         )
+        pending = [
+            x
+            for x in changed
+            if not self.synced(*x, root_id, root_path, snapshot, state)
+        ]
+        if paths is not None:
+            paths = {str(x) for x in paths}
 
-        df["cloud_type"] = df["mime_type"].map(mime_mapper)
-        df["local_name"] = df["cloud_name"]
-        df["local_path"] = None
-        google_mimes = df["cloud_type"].isin(GoogleDrive.google_mimes)
-        df.loc[google_mimes, "local_name"] = df.loc[google_mimes].apply(
-            lambda x: f"{x['cloud_name']}.{x['cloud_type']}", axis=1
+            def inside(file_id, file):
+                # Where the file was and where it is now
+                row = state.by_id(file_id)
+                found = [row.path] if row is not None else []
+                if file is not None:
+                    found.append(
+                        self.snapshot_path(file, root_id, str(root_path), snapshot)
+                    )
+                return all(x is not None and under_paths(x, paths) for x in found)
+
+            pending = [x for x in pending if not inside(*x)]
+        if pending:
+            log.info(f"{len(pending)} changes in the cloud to sync")
+        return bool(pending)
+
+    @staticmethod
+    def snapshot_current(status, snapshot, rules=None):
+        # The snapshot leaves out what the rules ignore, so new rules list
+        # everything again
+        digest = rules.digest() if rules is not None else None
+        return bool(
+            status.get("page_token")
+            and len(snapshot)
+            and status.get("rules") == digest
         )
 
-        folder_rows = df["cloud_type"] == "folder"
+    @staticmethod
+    def snapshot_files(root_id, root_path, snapshot, paths):
+        # Pages of the snapshot for a partial pass: the contents of the
+        # folders on the way to paths and of everything below them
+        on_the_way = ancestors(paths)
+        seen = set()
+        queue = [(root_id, str(root_path))]
+        while queue:
+            folder_id, folder_path = queue.pop()
+            page = snapshot.children(folder_id)
+            for file in page:
+                if file["mimeType"] != MimeType.FOLDER.value or file["id"] in seen:
+                    continue
+                seen.add(file["id"])
+                path = os.path.join(folder_path, file["name"])
+                if path in on_the_way or under_paths(path, paths):
+                    queue.append((file["id"], path))
+            yield page
 
-        def update_paths(base_id, base_path, root=False):
-            child_rows = df["parent"] == base_id
-            child_folder_rows = child_rows & folder_rows
+    def list_files_incremental(self, root_id, status, snapshot, rules=None):
+        if self.snapshot_current(status, snapshot, rules):
+            try:
+                status["page_token"] = self.apply_changes(
+                    status["page_token"], snapshot, root_id, rules=rules
+                )
+                return snapshot.pages()
+            except HttpError as e:
+                if e.resp.status not in (400, 404, 410):
+                    raise
+                log.info("Changes page token is no longer valid, listing all files")
 
-            if child_rows.any():
-                df.loc[child_rows, "local_path"] = df.loc[child_rows].apply(
-                    lambda x: base_path / x["local_name"], axis=1
+        # Take the token before listing so changes made meanwhile are replayed
+        page_token = self.get_start_page_token()
+
+        def pages():
+            snapshot.clear()
+            for page in self.list_files(root_id, rules):
+                for file in page:
+                    snapshot.put(file)
+                yield page
+            snapshot.commit()
+            status["page_token"] = page_token
+            status["rules"] = rules.digest() if rules is not None else None
+
+        return pages()
+
+    def get_root(self):
+        return self.files.get(fileId="root").execute()
+
+    def get_cloud_files(
+        self,
+        root_id,
+        root_path,
+        status=None,
+        snapshot=None,
+        rules=None,
+        hidden=None,
+        paths=None,
+    ):
+        # Ignored folders are not descended; the tree drops ignored paths,
+        # and hidden gets their folders' ids. A partial pass takes the
+        # snapshot as it is, poll_changes brings it up to date beforehand
+        if snapshot is None:
+            pages = self.list_files(root_id, rules)
+        elif paths is not None and self.snapshot_current(status, snapshot, rules):
+            pages = self.snapshot_files(root_id, root_path, snapshot, paths)
+        else:
+            pages = self.list_files_incremental(root_id, status, snapshot, rules)
+
+        # One compact record per file, built as pages arrive
+        files = {}
+        ignored = 0
+        for page in pages:
+            for file in page:
+                if rules is not None and rules.ignored_cloud_type(file["mimeType"]):
+                    ignored += 1
+                    if hidden is not None:
+                        hidden.update(file.get("parents") or ())
+                    continue
+                if file["id"] in files:
+                    files[file["id"]].parent = file.get("parents")
+                    continue
+                files[file["id"]] = CloudFile(
+                    file["id"],
+                    file["name"],
+                    mime_mapper(file["mimeType"]),
+                    file.get("modifiedTime"),
+                    int(file["size"]) if "size" in file else None,
+                    file.get("md5Checksum"),
+                    file.get("webViewLink"),
+                    file.get("parents"),
                 )
 
-            for id in df[child_folder_rows].index:
-                update_paths(id, df.at[id, "local_path"])
+        placed = build_tree(root_id, root_path, files.values(), rules, hidden)
+        skipped = len(files) - len(placed)
+        if skipped:
+            log.info(f"Skipping {skipped} files ignored or outside of the sync root")
+        if ignored:
+            log.info(f"Skipping {ignored} files of ignored types")
+        return placed
+
+    def _download_file(self, file_id, path, md5=None, sessions=None):
+        # Progress is the partial file itself, the session records which
+        # version of which file it holds so a later run can continue it
+        tmp_path = path.with_name(path.name + partial_suffix)
+        offset = 0
+        hash_md5 = None
+        if sessions is not None and tmp_path.exists():
+            if sessions.matches(path, file_id, md5):
+                offset = tmp_path.stat().st_size
+                hash_md5 = md5_file(tmp_path)
+                log.info(f"Resuming download of `{path.name}` at {offset} bytes")
+            else:
+                tmp_path.unlink()
+        if sessions is not None and offset == 0:
+            sessions.put(path, file_id, md5)
 
-        update_paths(root_id, root_path)
-        return df
+        req = self.thread_files().get_media(fileId=file_id)
+        with tmp_path.open("ab" if offset else "wb") as f:
+            throttle = self.transfers.throttle("download", self.metrics)
+            writer = HashingWriter(f, hash_md5)
+            downloader = MediaIoBaseDownload(writer, req, chunksize=self.chunk_size)
+            # Continues with a Range request from the end of the partial file
+            downloader._progress = offset  # pylint: disable=protected-access
+            # A partial file can be complete if the rename was interrupted
+            done = hash_md5 is not None and hash_md5.hexdigest() == md5
+            received = offset
+            while done is False:
+                # Chunks go straight to the http object, not through execute
+                status = self.schedule("drive.files.get_media", downloader.next_chunk)
+                done = status[1]
+                f.flush()
+                # Shaped once the chunk is in, so the wait holds no request slot
+                if throttle is not None:
+                    throttle(status[0].resumable_progress - received)
+                    received = status[0].resumable_progress
 
-    def download(self, df):
-        for path, row in df.iterrows():
-            if row["cloud_type"] == "folder":
-                path.mkdir(parent=True, exist_ok=True)
+        if isinstance(md5, str) and writer.md5.hexdigest() != md5:
+            tmp_path.unlink()
+            if sessions is not None:
+                sessions.remove(path)
+            if offset:
+                log.info(f"Resumed download of `{path.name}` is corrupt, restarting")
+                return self._download_file(file_id, path, md5, sessions)
+            raise RuntimeError(f"Checksum mismatch downloading `{path}`")
+        os.replace(tmp_path, path)
+        # Taken right away, an edit after this shows up as a local change
+        stat = path.stat()
+        if sessions is not None:
+            sessions.remove(path)
+        log.info(f"Downloaded `{path.name}`")
+        return stat.st_size - offset, stat
+
+    def download(self, entries, local_sources=None, sessions=None):
+        # Content already present locally is copied instead of downloaded.
+        # Entries get the stat of the file written for them
+        local_sources = dict(local_sources or {})
+        pending = []
+        duplicates = []
+        for entry in entries:
+            path = Path(entry.path)
+            cloud = entry.cloud
+            if cloud.type == "folder":
+                path.mkdir(parents=True, exist_ok=True)
             else:
                 path.parent.mkdir(parents=True, exist_ok=True)
-                if row["cloud_type"] in GoogleDrive.google_mimes:
+                md5 = cloud.md5
+                if cloud.type in GoogleDrive.google_mimes:
                     log.info(f"Linking `{path.name}`")
                     with path.open("w") as f:
                         json.dump(
                             {
-                                "url": row["url"],
+                                "url": cloud.url,
                                 "account_email": self.email_address,
-                                "file_id": row["id"],
+                                "file_id": entry.id,
                             },
                             f,
                         )
+                    entry.stat = path.stat()
+                elif isinstance(md5, str) and md5 in local_sources:
+                    duplicates.append((local_sources[md5], entry))
                 else:
-                    log.info(f"Downloading `{path.name}`")
-                    req = self.files.get_media(fileId=row["id"])
-                    with path.open("wb") as f:
-                        downloader = MediaIoBaseDownload(f, req)
-                        done = False
-                        while done is False:
-                            done = downloader.next_chunk()[1]
-
-    def upload(self, df):
-        for path, row in df.iterrows():
-            if row["parent"] is None:
-                raise RuntimeError(f"parent cannot be null for {path}")
-            if row["local_type"] in GoogleDrive.google_mimes:
-                log.info(f'Copying file {path.name}')
-                with path.open() as f:
+                    pending.append(entry)
+                    if isinstance(md5, str):
+                        local_sources[md5] = path
+
+        if pending:
+            log.info(f"Downloading {len(pending)} files")
+            start = time.monotonic()
+            transfers = self.transfers
+            pending.sort(
+                key=lambda x: transfers.priority(x.path, x.cloud.size, x.cloud.mtime)
+            )
+
+            def fetch(entry):
+                return self.in_slot(
+                    self._download_file,
+                    entry.id,
+                    Path(entry.path),
+                    entry.cloud.md5,
+                    sessions,
+                )
+
+            results = transfers.run(
+                pending, fetch, lambda x: x.cloud.size, self.download_workers
+            )
+            total = 0
+            for entry, (size, stat) in zip(pending, results):
+                entry.stat = stat
+                total += size
+            elapsed = max(time.monotonic() - start, 1e-6)
+            self.metrics.count("files_downloaded", len(pending))
+            self.metrics.count("bytes_downloaded", total)
+            self.metrics.count("download_seconds", elapsed)
+            log.info(
+                f"Downloaded {len(pending)} files, {total / 2**20:.1f} MiB "
+                f"in {elapsed:.1f}s ({total / 2**20 / elapsed:.2f} MiB/s)"
+            )
+
+        if duplicates:
+            log.info(f"Copying {len(duplicates)} files that already exist locally")
+            self.metrics.count("files_copied_local", len(duplicates))
+            for source, entry in duplicates:
+                path = Path(entry.path)
+                tmp_path = path.with_name(path.name + partial_suffix)
+                copy_file(source, tmp_path)
+                os.replace(tmp_path, path)
+                entry.stat = path.stat()
+
+    def _upload_file(self, entry, sessions=None):
+        path = Path(entry.path)
+        with path.open("rb") as f:
+            stat = os.fstat(f.fileno())
+            reader = HashingReader(f)
+            resp = self._upload_media(entry, path, stat, reader, sessions)
+        # The content is hashed as it goes up. A resumed upload only read
+        # part of it, Drive's checksum of the whole file stands in then
+        md5 = resp.get("md5Checksum")
+        if reader.hashed == stat.st_size:
+            if md5 is not None and md5 != reader.md5.hexdigest():
+                raise RuntimeError(f"Checksum mismatch uploading `{path}`")
+            md5 = reader.md5.hexdigest()
+        return resp["id"], md5, stat
+
+    def _upload_media(self, entry, path, stat, reader, sessions):
+        self.metrics.count("bytes_uploaded", stat.st_size)
+        files = self.thread_files()
+        # Files that fit in one chunk go up in a single multipart request
+        resumable = stat.st_size > self.chunk_size
+        media = MediaIoBaseUpload(
+            reader,
+            mimetypes.guess_type(path.name)[0] or "application/octet-stream",
+            chunksize=self.chunk_size,
+            resumable=resumable,
+        )
+        fields = "id, md5Checksum"
+        # Each request is shaped before it is scheduled, so the wait holds no
+        # request slot
+        throttle = self.transfers.throttle("upload", self.metrics)
+        if entry.id is not None:
+            target = entry.id
+            request = files.update(fileId=target, media_body=media, fields=fields)
+        else:
+            target = entry.parent
+            request = files.create(
+                body={"name": entry.name, "parents": [entry.parent]},
+                media_body=media,
+                fields=fields,
+            )
+
+        if not resumable:
+            log.info(f"Uploading file {path.name}")
+            if throttle is not None:
+                throttle(stat.st_size)
+            return request.execute()
+
+        session = sessions.get(path, target, stat) if sessions else None
+        if session is not None:
+            log.info(f"Resuming upload of {path.name}")
+            # Makes the next chunk query the server for the committed range
+            request.resumable_uri = session
+            request._in_error_state = True  # pylint: disable=protected-access
+        else:
+            log.info(f"Uploading file {path.name}")
+
+        resp = None
+        while resp is None:
+            if throttle is not None:
+                remaining = stat.st_size - request.resumable_progress
+                throttle(min(self.chunk_size, remaining))
+            try:
+                resp = request.next_chunk()[1]
+            except HttpError as e:
+                if session is None or e.resp.status not in (404, 410):
+                    raise
+                log.info(f"Upload session for {path.name} expired, restarting")
+                sessions.remove(path)
+                session = request.resumable_uri = None
+                request.resumable_progress = 0
+                request._in_error_state = False  # pylint: disable=protected-access
+                continue
+            if sessions is not None and request.resumable_uri != session:
+                session = request.resumable_uri
+                sessions.put(path, target, stat, session)
+        if sessions is not None:
+            sessions.remove(path)
+        return resp
+
+    def move(self, moves):
+        # Batched calls go out on the connection of the thread that built them
+        files = self.thread_files()
+        requests = {}
+        for old, new, file_id, old_parent, new_parent in moves:
+            log.info(f"Moving `{old.name}` to `{new}`")
+            kwargs = {}
+            if old_parent != new_parent:
+                kwargs = {"addParents": new_parent, "removeParents": old_parent}
+            requests[new] = files.update(
+                fileId=file_id, body={"name": new.name}, fields="id", **kwargs
+            )
+        self.metrics.count("cloud_moved", len(moves))
+        self.execute_batch(requests)
+
+    def execute_batch(self, requests, retries=5):
+        results = {}
+        pending = dict(requests)
+        for attempt in range(retries + 1):
+            keys = list(pending)
+            errors = {}
+
+            def callback(request_id, response, exception):
+                key = keys[int(request_id)]
+                if exception is None:
+                    results[key] = response
+                    del pending[key]
+                else:
+                    errors[key] = exception
+
+            for i in range(0, len(keys), GoogleDrive.batch_size):
+                batch = self.thread_service().new_batch_http_request(
+                    callback=callback
+                )
+                end = min(i + GoogleDrive.batch_size, len(keys))
+                for j in range(i, end):
+                    batch.add(pending[keys[j]], request_id=str(j))
+                    self.metrics.count_call(pending[keys[j]].methodId)
+                # Drive charges quota per call in the batch, not per batch
+                self.schedule("batch", batch.execute, tokens=end - i)
+
+            if not errors:
+                break
+            fatal = [x for x in errors.values() if not is_retryable(x)]
+            if fatal or attempt == retries:
+                raise (fatal or list(errors.values()))[0]
+            log.info(f"Retrying {len(errors)} failed calls in the batch")
+            self.metrics.count("retries", len(errors))
+            if any(is_quota_error(x) for x in errors.values()):
+                self.scheduler.throttle()
+            self.scheduler.backoff(attempt, metrics=self.metrics)
+        return results
+
+    def upload(self, entries, sessions=None, cloud_sources=None, hashed=None):
+        # New files whose content is already in the cloud are copied there.
+        # Entries get the id of what was created for them, and uploaded files
+        # the md5 their upload computed, also added to hashed
+        cloud_sources = dict(cloud_sources or {})
+        files = self.thread_files()
+        copies = {}
+        folders = {}
+        pending = []
+        duplicates = {}
+        for entry in entries:
+            local = entry.local
+            if entry.parent is None:
+                raise RuntimeError(f"parent cannot be null for {entry.path}")
+            if local.type in GoogleDrive.google_mimes:
+                log.info(f"Copying file {os.path.basename(entry.path)}")
+                with open(entry.path) as f:
                     data = json.load(f)
                 log.info(data['file_id'])
-                new_file = self.files.copy(
+                copies[entry] = files.copy(
                     fileId=data["file_id"],
-                    body={"name": row["cloud_name"], "parents": [row["parent"]]},
+                    body={"name": entry.name, "parents": [entry.parent]},
                     fields="id, webViewLink",
-                ).execute()
-                with path.open("w") as f:
-                    json.dump(
-                        {
-                            "url": new_file['webViewLink'],
-                            "account_email": self.email_address,
-                            "file_id": new_file["id"],
-                        },
-                        f,
-                    )
-            elif row["local_type"] == "folder":
-                log.info(f'Creating folder {path.name}')
-                new_file = self.files.create(
+                )
+            elif local.type == "folder":
+                log.info(f"Creating folder {os.path.basename(entry.path)}")
+                folders[entry] = files.create(
                     body={
-                        "name": row["cloud_name"],
+                        "name": entry.name,
                         "mimeType": get_mime("folder"),
-                        "parents": [row["parent"]],
+                        "parents": [entry.parent],
                     },
                     fields="id",
-                ).execute()
+                )
+            elif entry.id is None and local.md5 in cloud_sources:
+                duplicates[entry] = cloud_sources[local.md5]
             else:
-                log.info(f'Uploading file {path.name}')
-                media = MediaFileUpload(path)
-                new_file = self.files.create(
-                    body={"name": row["cloud_name"], "parents": [row["parent"]]}, media_body=media, fields="id"
-                ).execute()
-            df.at[path, "id"] = new_file["id"]
-        return df
-
-    def delete(self, df):
-        for path, row in df.iterrows():
-            log.info(f'Deleting {path.name}')
-            self.files.delete(fileId=row["id"]).execute()
-
-    def sync(self, root_id, root_path, status):
-        cloud_df = self.get_cloud_df(root_id, root_path)
-        local_df = get_local_df(root_path)
-
-        df = pd.merge(
-            cloud_df.reset_index(),
-            local_df,
-            how="outer",
-            indicator=True,
-            on="local_path",
-        ).set_index("local_path")
-
-        cloud_extra = df["_merge"] == "left_only"
-        to_download = cloud_extra & (df["cloud_mtime"] > status["start_time"])
-        to_delete_cloud = cloud_extra & (df["cloud_mtime"] <= status["start_time"])
-
-        local_extra = df["_merge"] == "right_only"
-        df.loc[local_extra, "local_name"] = df.loc[local_extra].apply(
-            lambda x: x.name.name, axis=1
+                pending.append(entry)
+                if entry.id is None and isinstance(local.md5, str):
+                    # Later copies of the same content reuse this upload
+                    cloud_sources[local.md5] = entry
+
+        for entry, new_file in self.execute_batch(folders).items():
+            entry.id = new_file["id"]
+
+        for entry, new_file in self.execute_batch(copies).items():
+            with open(entry.path, "w") as f:
+                json.dump(
+                    {
+                        "url": new_file['webViewLink'],
+                        "account_email": self.email_address,
+                        "file_id": new_file["id"],
+                    },
+                    f,
+                )
+            entry.id = new_file["id"]
+
+        self.metrics.count("folders_created", len(folders))
+        self.metrics.count("links_copied", len(copies))
+        if pending:
+            start = time.monotonic()
+            transfers = self.transfers
+            pending.sort(
+                key=lambda x: transfers.priority(x.path, x.local.size, x.local.mtime)
+            )
+            results = transfers.run(
+                pending,
+                lambda x: self.in_slot(self._upload_file, x, sessions),
+                lambda x: x.local.size,
+                self.upload_workers,
+            )
+            for entry, (file_id, md5, stat) in zip(pending, results):
+                entry.id, entry.local.md5 = file_id, md5
+                if hashed is not None and md5 is not None:
+                    hashed.append((entry.path, stat, md5))
+            self.metrics.count("files_uploaded", len(pending))
+            self.metrics.count("upload_seconds", time.monotonic() - start)
+
+        if duplicates:
+            log.info(f"Copying {len(duplicates)} files that already exist in cloud")
+            self.metrics.count("files_copied_cloud", len(duplicates))
+            requests = {}
+            for entry, source in duplicates.items():
+                if isinstance(source, Entry):
+                    source = source.id
+                requests[entry] = files.copy(
+                    fileId=source,
+                    body={"name": entry.name, "parents": [entry.parent]},
+                    fields="id",
+                )
+            for entry, new_file in self.execute_batch(requests).items():
+                entry.id = new_file["id"]
+
+    def delete(self, entries):
+        # Deleting a folder removes its contents, so skip children of deleted folders
+        deleted_ids = {x.id for x in entries}
+        files = self.thread_files()
+        requests = {}
+        for entry in entries:
+            log.info(f"Deleting {os.path.basename(entry.path)}")
+            if entry.parent not in deleted_ids:
+                requests[entry] = files.delete(fileId=entry.id)
+        self.metrics.count("cloud_deleted", len(entries))
+        self.execute_batch(requests)
+
+    @staticmethod
+    def state_rows(entries, downloaded, uploaded):
+        rows = []
+        for entry in entries:
+            local, cloud = entry.local, entry.cloud
+            md5 = size = local_mtime = cloud_mtime = None
+            if local is not None:
+                md5, size, local_mtime = local.md5, local.size, local.mtime
+            if cloud is not None:
+                cloud_mtime = cloud.mtime
+            if entry in downloaded:
+                # Downloads take their content from the cloud copy, and the
+                # size and mtime from when it was written, not from now
+                md5 = cloud.md5
+                local_mtime = size = None
+                stat = entry.stat
+                if stat is None and os.path.exists(entry.path):
+                    stat = os.stat(entry.path)
+                if stat is not None:
+                    local_mtime = max(stat.st_mtime, stat.st_ctime)
+                    size = stat.st_size
+            elif entry in uploaded:
+                cloud_mtime = None
+            rows.append((entry.path, entry.id, md5, size, local_mtime, cloud_mtime))
+        return rows
+
+    def plan_sync(
+        self,
+        root_id,
+        root_path,
+        status,
+        hash_cache=None,
+        snapshot=None,
+        upload_sessions=None,
+        paths=None,
+        state=None,
+        download_sessions=None,
+        strict=False,
+        rules=None,
+    ):
+        metrics = self.metrics
+        metrics.phase("list_cloud")
+        # Ids of folders holding cloud files the rules hide
+        hidden = set()
+        if paths is not None:
+            paths = {str(x) for x in paths}
+        all_cloud_files = self.get_cloud_files(
+            root_id, root_path, status, snapshot, rules, hidden, paths
         )
-        df.loc[local_extra, "cloud_name"] = df.loc[local_extra].apply(
-            lambda x: x.name.stem
-            if x["local_type"] in GoogleDrive.google_mimes
-            else x.name.name,
-            axis=1,
+        metrics.phase("scan_local")
+        # Files whose size and mtime match the last sync skip hashing
+        base_rows = state.rows(paths) if state is not None else []
+        known = {x.path: x for x in base_rows}
+        # A file whose size no cloud or synced file has cannot match their
+        # content, it gets hashed by its upload instead of read twice
+        defer = None
+        sizes = {x.size for x in all_cloud_files} | {x.size for x in base_rows}
+        unsized = any(x.size is None and x.md5 is not None for x in all_cloud_files)
+        if state is not None and not strict and not unsized:
+
+            def defer(record):
+                return record.type not in google_types and record.size not in sizes
+
+        local_files = get_local_files(
+            root_path, hash_cache, paths, metrics, known, strict, rules, defer
         )
-        to_upload = local_extra & (df["local_mtime"] > status["end_time"])
-        to_delete_local = local_extra & (df["local_mtime"] <= status["end_time"])
 
-        to_update = (
-            (df["_merge"] == "both")
-            & (df["local_md5"] != df["cloud_md5"])
-            & (~df["cloud_type"].isin(GoogleDrive.google_mimes))
+        metrics.phase("classify")
+        root = str(root_path)
+
+        # Local path to cloud id, extended as new folders get created
+        cloud_ids = {root: root_id}
+        cloud_ids.update((x.path, x.id) for x in all_cloud_files)
+
+        cloud_files = all_cloud_files
+        if paths is not None:
+            # Restrict every side to the given paths and anything below them
+            cloud_files = [x for x in cloud_files if under_paths(x.path, paths)]
+
+        entries, duplicates = join(cloud_files, local_files, base_rows)
+        if duplicates:
+            log.info(f"Skipping {duplicates} cloud files with a duplicate path")
+        if rules is not None and rules.max_size is not None:
+            # Too large on either side leaves the path alone on both, state
+            # included
+            oversized = [
+                path
+                for path, entry in entries.items()
+                if any(
+                    x is not None and rules.too_large(x.size)
+                    for x in (entry.cloud, entry.local)
+                )
+            ]
+            for path in oversized:
+                if entries[path].cloud is not None:
+                    hidden.add(entries[path].cloud.parent)
+                del entries[path]
+            if oversized:
+                log.info(f"Skipping {len(oversized)} files over the size limit")
+        changes = classify(entries, track_moves=state is not None)
+        if paths is None:
+            log.info(f"{changes.unchanged} files unchanged since the last sync")
+        for entry in changes.moved_up:
+            cloud_ids[entry.path] = entry.id
+        cloud_moves, local_moves = changes.cloud_moves, changes.local_moves
+
+        # Content on either side that transfers can reuse, leaving out paths
+        # this pass is about to overwrite, or that rename_local moves away
+        overwritten = {x.path for x in changes.download + changes.update_local}
+        renamed = {str(x[0]) for x in cloud_moves}
+        local_sources = {
+            x.md5: Path(x.path)
+            for x in local_files
+            if isinstance(x.md5, str)
+            and x.path not in overwritten
+            and not under_paths(x.path, renamed)
+        }
+        overwritten = {x.id for x in changes.update_cloud}
+        cloud_sources = {
+            x.md5: x.id
+            for x in all_cloud_files
+            if isinstance(x.md5, str) and x.id not in overwritten
+        }
+
+        # Operations share the entries and cloud_ids, and change them under
+        # this lock. Uploads add what they hashed for the state to record
+        lock = threading.Lock()
+        hashed = []
+        plan = Plan()
+
+        def set_parents(temp_entries):
+            for entry in temp_entries:
+                entry.parent = cloud_ids.get(os.path.dirname(entry.path))
+
+        def paths_of(temp_entries):
+            return [x.path for x in temp_entries]
+
+        def rename_local():
+            log.info(f"{len(cloud_moves)} files moved in cloud, moving them in local")
+            metrics.count("local_moved", len(cloud_moves))
+            renamed = []
+            for old, new in cloud_moves:
+                # Earlier folder renames may have carried this path along
+                for folder_old, folder_new in renamed:
+                    if folder_old in old.parents:
+                        old = folder_new / old.relative_to(folder_old)
+                log.info(f"Moving `{old}` to `{new}`")
+                new.parent.mkdir(parents=True, exist_ok=True)
+                os.rename(old, new)
+                renamed.append((old, new))
+            for entry in changes.moved_down:
+                if os.path.exists(entry.path):
+                    entry.stat = os.stat(entry.path)
+
+        # Partial downloads of files this pass does not download are left
+        # over from deleted or since synced files. They go before any rename
+        # carries them along
+        wanted = {x.path for x in changes.download + changes.update_local}
+        orphans = []
+        if download_sessions is not None:
+            orphans = [
+                Path(x)
+                for x in download_sessions.paths()
+                if x not in wanted and (paths is None or under_paths(x, paths))
+            ]
+
+        def remove_partials():
+            log.info(f"Removing {len(orphans)} partial downloads no longer needed")
+            for path in orphans:
+                path.with_name(path.name + partial_suffix).unlink(missing_ok=True)
+                download_sessions.remove(path)
+
+        partials = plan.add("remove_partials", "delete_local", orphans, remove_partials)
+
+        # Local renames come first, everything else may touch the paths
+        renames = plan.add(
+            "rename_local", "move_local", cloud_moves, rename_local, [partials]
         )
-        to_update_local = (
-            to_update
-            & (df["cloud_mtime"] > df["local_mtime"])
-            & (df["local_type"] != "folder")
+
+        def download(temp_entries, message):
+            def run():
+                log.info(f"{len(temp_entries)} {message}")
+                self.download(temp_entries, local_sources, download_sessions)
+
+            return run
+
+        downloads = plan.add(
+            "download",
+            "download",
+            paths_of(changes.download),
+            download(changes.download, "new files to download"),
+            [renames],
         )
-        to_update_cloud = (
-            to_update
-            & (df["cloud_mtime"] < df["local_mtime"])
-            & (df["local_type"] != "folder")
+        updates_down = plan.add(
+            "update_local",
+            "download",
+            paths_of(changes.update_local),
+            download(
+                changes.update_local, "files updated in cloud, downloading them"
+            ),
+            [renames],
         )
 
-        temp_df = df[to_download]
-        if len(temp_df):
-            log.info(f"{len(temp_df)} new files to download")
-            self.download(temp_df)
+        def create_folders(temp_entries):
+            def run():
+                with lock:
+                    set_parents(temp_entries)
+                self.upload(temp_entries, upload_sessions)
+                with lock:
+                    cloud_ids.update((x.path, x.id) for x in temp_entries)
 
-        temp_df = df[to_update_local]
-        if len(temp_df):
-            log.info(f"{len(temp_df)} files updated in cloud, downloading them")
-            self.download(temp_df)
+            return run
 
-        def find_parent(row):
-            if row.name.parent == root_path:
-                return root_id
+        # Create folders a level at a time so every level's parents exist
+        levels = {}
+        for entry in changes.upload:
+            if entry.local.type == "folder":
+                level = os.path.relpath(entry.path, root).count(os.sep) + 1
+                levels.setdefault(level, []).append(entry)
+        folder_ops = [renames]
+        for level in sorted(levels):
+            folder_ops.append(
+                plan.add(
+                    f"create_folders_{level}",
+                    "create_folder",
+                    paths_of(levels[level]),
+                    create_folders(levels[level]),
+                    folder_ops[-1:],
+                )
+            )
 
-            values = df.loc[df.index == row.name.parent]["id"].values
-            if len(values):
-                return values[0]
-            else:
-                return None
+        def move_cloud():
+            log.info(f"{len(local_moves)} files moved in local, moving them in cloud")
+            moves = []
+            with lock:
+                for old, new in local_moves:
+                    entry = entries[str(old)]
+                    new_parent = cloud_ids[str(new.parent)]
+                    moves.append((old, new, entry.id, entry.parent, new_parent))
+            self.move(moves)
 
-        df.loc[to_upload, "parent"] = df.loc[to_upload].apply(
-            lambda x: find_parent(x), axis=1
+        moves_up = plan.add(
+            "move_cloud",
+            "move_cloud",
+            local_moves,
+            move_cloud,
+            folder_ops,
         )
 
-        # Upload folders first go get the id's to assign as parents
-        temp_df = df[to_upload & (df["local_type"] == "folder")]
-        if len(temp_df):
-            log.info(f"{len(temp_df)} new folders to create")
-            df.update(self.upload(temp_df))
-            df.loc[to_upload, "parent"] = df.loc[to_upload].apply(
-                lambda x: find_parent(x), axis=1
-            )
+        def upload(temp_entries, message, sources=None):
+            def run():
+                with lock:
+                    set_parents(temp_entries)
+                log.info(f"{len(temp_entries)} {message}")
+                self.upload(temp_entries, upload_sessions, sources, hashed)
 
-        temp_df = df[to_upload & (df["local_type"] != "folder")]
-        if len(temp_df):
-            log.info(f"{len(temp_df)} new files to upload")
-            df.update(self.upload(temp_df))
+            return run
 
-        temp_df = df[to_update_cloud & (df["local_type"] != "folder")]
-        if len(temp_df):
-            log.info(f"{len(temp_df)} files updated in local, uploading them to cloud")
-            df.update(self.upload(temp_df))
+        # Files in folders that already exist need not wait for new folders
+        new_files = [x for x in changes.upload if x.local.type != "folder"]
+        in_new_folder = [
+            x for x in new_files if os.path.dirname(x.path) not in cloud_ids
+        ]
+        in_folder = [x for x in new_files if os.path.dirname(x.path) in cloud_ids]
+        uploads = plan.add(
+            "upload",
+            "upload",
+            paths_of(in_folder),
+            upload(in_folder, "new files to upload", cloud_sources),
+            [renames],
+        )
+        uploads_new = plan.add(
+            "upload_new_folders",
+            "upload",
+            paths_of(in_new_folder),
+            upload(in_new_folder, "new files in new folders to upload", cloud_sources),
+            folder_ops,
+        )
+        updated = [x for x in changes.update_cloud if x.local.type != "folder"]
+        updates_up = plan.add(
+            "update_cloud",
+            "upload",
+            paths_of(updated),
+            upload(updated, "files updated in local, uploading them to cloud"),
+            [renames],
+        )
 
-        temp_df = df[to_delete_local]
-        if len(temp_df):
+        def delete_local():
             log.info(
-                f"{len(temp_df)} files deleted in the cloud, deleting them in local"
+                f"{len(deleted_local)} files deleted in the cloud, "
+                "deleting them in local"
             )
-            for path in df[to_delete_local].index:
+            metrics.count("local_deleted", len(deleted_local))
+            for path in deleted_local:
                 log.info(f"Deleting `{path.name}`")
-                delete_path(path)
+                delete_path(path, rules)
 
-        temp_df = df[to_delete_cloud]
-        if len(temp_df):
+        # Downloads may copy from local files about to be deleted, and
+        # uploads from cloud files about to be deleted
+        deleted_local = [Path(x.path) for x in changes.delete_local]
+        plan.add(
+            "delete_local",
+            "delete_local",
+            deleted_local,
+            delete_local,
+            [partials, renames, downloads, updates_down],
+        )
+        # Deleting a folder in Drive takes hidden files along, so folders
+        # holding any stay and their synced contents go one by one
+        folder_ids = {x.id: x.path for x in all_cloud_files if x.type == "folder"}
+        protected = {folder_ids[x] for x in hidden if x in folder_ids}
+        protected |= ancestors(protected)
+        deleted_cloud = [x for x in changes.delete_cloud if x.path not in protected]
+        if len(deleted_cloud) < len(changes.delete_cloud):
+            kept = len(changes.delete_cloud) - len(deleted_cloud)
+            log.info(f"Keeping {kept} cloud folders that hold ignored files")
+
+        def delete_cloud():
             log.info(
-                f"{len(temp_df)} files deleted in the local, deleting them in cloud"
+                f"{len(deleted_cloud)} files deleted in the local, "
+                "deleting them in cloud"
+            )
+            self.delete(deleted_cloud)
+
+        plan.add(
+            "delete_cloud",
+            "delete_cloud",
+            paths_of(deleted_cloud),
+            delete_cloud,
+            [moves_up, uploads, uploads_new, updates_up],
+        )
+
+        def update_state():
+            if changes.only_base:
+                state.remove(changes.only_base)
+            # Everything still on both sides is now in sync
+            downloaded = set(
+                changes.download + changes.update_local + changes.moved_down
+            )
+            uploaded = set(changes.upload + changes.update_cloud + changes.moved_up)
+            synced = [
+                x
+                for x in changes.entries
+                if (x.cloud is not None and x.local is not None)
+                or x in downloaded
+                or x in uploaded
+            ]
+            state.put(self.state_rows(synced, downloaded, uploaded))
+            deleted = changes.delete_local + changes.delete_cloud + changes.moved_from
+            state.remove(paths_of(deleted))
+            state.commit()
+            if hash_cache is not None and hashed:
+                for path, stat, md5 in hashed:
+                    hash_cache.store(path, stat, md5)
+                hash_cache.commit()
+
+        if state is not None:
+            plan.add(
+                "update_state",
+                "state",
+                paths_of(changes.entries) + changes.only_base,
+                update_state,
+                plan.names(),
+                inline=True,
             )
-            self.delete(temp_df)
+        return plan
+
+    def sync(self, root_id, root_path, status, dry_run=False, workers=8, **kwargs):
+        # Classification builds the plan, execution runs it; a dry run stops
+        # after planning
+        metrics = self.metrics
+        plan = self.plan_sync(root_id, root_path, status, **kwargs)
+        if dry_run:
+            metrics.phase(None)
+            return plan
+        metrics.phase("execute")
+        plan.execute(workers, metrics)
+        metrics.phase(None)
+        return plan
 
         # upload google mime types pending
@@ -0,0 +1,92 @@
+from collections import defaultdict
+from pathlib import Path
+
+
+def collapse_folder_moves(pairs, old_paths, new_paths, same_content):
+    # Turns file level moves into moves of their topmost common folder, so a
+    # renamed folder costs one call instead of one per file inside it
+    candidates = set()
+    for old, new in pairs:
+        matching = old.name == new.name
+        old_parent, new_parent = old.parent, new.parent
+        while matching and old_parent in old_paths and new_parent in new_paths:
+            candidates.add((old_parent, new_parent))
+            matching = old_parent.name == new_parent.name
+            old_parent, new_parent = old_parent.parent, new_parent.parent
+
+    candidate_folders = {x[0] for x in candidates}
+    below = defaultdict(list)
+    for path in old_paths:
+        for parent in path.parents:
+            if parent in candidate_folders:
+                below[parent].append(path)
+
+    ops = []
+    covered = {}
+    for old, new in sorted(candidates, key=lambda x: len(x[0].parts)):
+        if old in covered or any(x in covered for x in old.parents):
+            continue
+        matched = {}
+        for path in below[old]:
+            target = new / path.relative_to(old)
+            if target in new_paths and same_content(path, target):
+                matched[path] = target
+        if len(matched) * 2 < len(below[old]):
+            continue
+        ops.append((old, new))
+        covered[old] = new
+        covered.update(matched)
+
+    for old, new in pairs:
+        if old not in covered:
+            ops.append((old, new))
+            covered[old] = new
+    return ops, covered
+
+
+def find_local_moves(deleted, added):
+    # Paths deleted locally and still in the cloud, against new local paths
+    old_entries = {Path(x.path): x for x in deleted}
+    new_entries = {Path(x.path): x for x in added}
+
+    by_md5 = defaultdict(list)
+    for path, entry in old_entries.items():
+        md5 = entry.base.md5
+        if entry.cloud.type != "folder" and isinstance(md5, str):
+            by_md5[md5].append(path)
+
+    pairs = []
+    for path in sorted(new_entries, key=lambda x: len(x.parts)):
+        candidates = by_md5.get(new_entries[path].local.md5)
+        if not candidates:
+            continue
+        # Prefer a candidate with the same name, which is a plain move
+        old = next((x for x in candidates if x.name == path.name), candidates[0])
+        candidates.remove(old)
+        pairs.append((old, path))
+
+    def same_content(old, new):
+        old, new = old_entries[old], new_entries[new]
+        if old.cloud.type == "folder":
+            return new.local.type == "folder"
+        return old.base.md5 is not None and old.base.md5 == new.local.md5
+
+    return collapse_folder_moves(pairs, old_entries, new_entries, same_content)
+
+
+def find_cloud_moves(deleted, added):
+    # Paths gone from the cloud but still local, against new cloud paths
+    old_entries = {Path(x.path): x for x in deleted}
+    new_entries = {Path(x.path): x for x in added}
+
+    by_id = {y.base.id: x for x, y in old_entries.items()}
+    pairs = []
+    for path, entry in new_entries.items():
+        old = by_id.get(entry.id)
+        if old is not None:
+            pairs.append((old, path))
+
+    def same_content(old, new):
+        return old_entries[old].base.id == new_entries[new].id
+
+    return collapse_folder_moves(pairs, old_entries, new_entries, same_content)
@@ -0,0 +1,96 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from utils import get_logger, thread_pool
+
+log = get_logger(__file__)
+
+
+class Operation:
+    def __init__(self, name, kind, paths, run, deps, inline):
+        self.name = name
+        self.kind = kind
+        self.paths = paths
+        self.run = run
+        self.deps = deps
+        self.inline = inline
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "deps": self.deps,
+            "count": len(self.paths),
+            "paths": [
+                [str(y) for y in x] if isinstance(x, tuple) else str(x)
+                for x in self.paths
+            ],
+        }
+
+
+class Plan:
+    def __init__(self):
+        self.operations = {}
+
+    def __len__(self):
+        return len(self.operations)
+
+    def add(self, name, kind, paths, run, deps=(), inline=False):
+        # Empty operations are left out, and so are dependencies on them.
+        # Inline ones run on the executing thread, for sqlite connections
+        if not len(paths):
+            return None
+        deps = [x for x in deps if x is not None]
+        self.operations[name] = Operation(name, kind, list(paths), run, deps, inline)
+        return name
+
+    def names(self, kind=None):
+        return [x for x, y in self.operations.items() if kind in (None, y.kind)]
+
+    def to_dict(self):
+        return {"operations": [x.to_dict() for x in self.operations.values()]}
+
+    def describe(self):
+        lines = []
+        for operation in self.operations.values():
+            line = f"{operation.name}: {len(operation.paths)} {operation.kind}"
+            if operation.deps:
+                line += f" after {', '.join(operation.deps)}"
+            lines.append(line)
+        return lines
+
+    def execute(self, workers=8, metrics=None):
+        # Runs every operation as soon as the ones it depends on are done, so
+        # independent transfers and local changes overlap. The first failure
+        # stops anything new from starting
+        def timed(operation):
+            start = time.monotonic()
+            operation.run()
+            if metrics is not None:
+                elapsed = time.monotonic() - start
+                metrics.count(f"{operation.kind}_op_seconds", elapsed)
+
+        waiting = dict(self.operations)
+        done = set()
+        running = {}
+        with thread_pool(workers) as pool:
+            while waiting or running:
+                ready = [
+                    x for x in waiting.values() if all(y in done for y in x.deps)
+                ]
+                for operation in ready:
+                    del waiting[operation.name]
+                    if operation.inline:
+                        timed(operation)
+                        done.add(operation.name)
+                    else:
+                        running[pool.submit(timed, operation)] = operation.name
+                if not running:
+                    if waiting and not ready:
+                        raise RuntimeError(f"Unable to order {', '.join(waiting)}")
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    future.result()
+                    done.add(name)
@@ -0,0 +1,240 @@
+import multiprocessing
+import os
+import stat as stat_module
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from utils import get_logger, get_md5, partial_suffix, thread_pool
+
+log = get_logger(__file__)
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+
+class LocalFile:
+    __slots__ = ("path", "type", "mtime", "size", "md5")
+
+    def __init__(self, path, file_type, mtime, size=None, md5=None):
+        self.path = path
+        self.type = file_type
+        self.mtime = mtime
+        self.size = size
+        self.md5 = md5
+
+
+def folder_record(path, stat):
+    return LocalFile(str(path), "folder", stat.st_mtime)
+
+
+def file_record(path, stat):
+    path = str(path)
+    file_type = os.path.splitext(path)[1].strip(".")
+    return LocalFile(path, file_type, max(stat.st_mtime, stat.st_ctime), stat.st_size)
+
+
+def known_md5(record, stat, hash_cache, known):
+    # Cheapest first: a file with the size and mtime the last sync recorded
+    # still has the content synced then, otherwise the hash cache may know it
+    row = known.get(record.path)
+    if (
+        row is not None
+        and row.md5 is not None
+        and row.size == record.size
+        and row.local_mtime == record.mtime
+    ):
+        return row.md5
+    if hash_cache is not None:
+        return hash_cache.lookup(record.path, stat)
+    return None
+
+
+def hash_pool(max_workers=None):
+    # One pool per process, shared by every account, so starting the workers
+    # is paid once. They come from a forkserver: forking while the walk and
+    # other accounts' threads run could copy a held lock into them. The
+    # server imports the main module once instead of every worker
+    global _hash_pool  # pylint: disable=global-statement
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(["__main__", "utils"])
+            _hash_pool = ProcessPoolExecutor(max_workers, mp_context=context)
+        return _hash_pool
+
+
+def scan_dir(path):
+    dirs = []
+    files = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        # Symlinked folders are listed but not descended, like os.walk
+                        dirs.append((entry.path, entry.stat(), not entry.is_symlink()))
+                    elif not entry.name.endswith(partial_suffix):
+                        files.append((entry.path, entry.stat()))
+                except FileNotFoundError:
+                    continue
+    except OSError as e:
+        log.warning(f"Unable to scan `{path}`: {e}")
+    return dirs, files
+
+
+def scan_tree(
+    root_path,
+    hash_cache=None,
+    walk_workers=8,
+    hash_workers=None,
+    metrics=None,
+    known=None,
+    strict=False,
+    rules=None,
+    defer=None,
+):
+    # Strict scans hash every file, trusting neither the state nor the cache.
+    # Files defer accepts are left unhashed for their upload to hash
+    known = known or {}
+    file_list = []
+    hashing = []
+    deferred = []
+    hash_start = None
+    seen_paths = set()
+
+    def hash_later(record, stat):
+        nonlocal hash_start
+        if hash_start is None:
+            hash_start = time.monotonic()
+        pool = hash_pool(hash_workers)
+        hashing.append((record, stat, pool.submit(get_md5, record.path)))
+
+    # Folders are scanned on a thread pool while files that need hashing
+    # stream into a process pool, so walking and hashing overlap
+    with thread_pool(walk_workers) as walk_pool:
+        walking = {walk_pool.submit(scan_dir, str(root_path))}
+        while walking:
+            done, walking = wait(walking, return_when=FIRST_COMPLETED)
+            for future in done:
+                dirs, files = future.result()
+                for path, stat, descend in dirs:
+                    # Ignored folders are never descended
+                    if rules is not None and rules.ignored(path, True):
+                        continue
+                    file_list.append(folder_record(path, stat))
+                    if descend:
+                        walking.add(walk_pool.submit(scan_dir, path))
+
+                for path, stat in files:
+                    if rules is not None and rules.ignored(path):
+                        continue
+                    record = file_record(path, stat)
+                    file_list.append(record)
+                    # Too large files stay listed so the cloud copy is left
+                    # alone too, but are never read
+                    if rules is not None and rules.too_large(record.size):
+                        continue
+                    if hash_cache is not None:
+                        seen_paths.add(path)
+                    if not strict:
+                        record.md5 = known_md5(record, stat, hash_cache, known)
+                    if record.md5 is not None:
+                        continue
+                    if defer is not None and defer(record):
+                        deferred.append((record, stat))
+                    else:
+                        hash_later(record, stat)
+
+    # Deferred files of the same size may be copies of each other, which
+    # uploads reuse, so those get hashed after all
+    sizes = Counter(x[0].size for x in deferred)
+    for record, stat in deferred:
+        if sizes[record.size] > 1:
+            hash_later(record, stat)
+    if metrics is not None:
+        metrics.count("files_hash_deferred", sum(sizes[x] == 1 for x in sizes))
+
+    if hashing:
+        log.info(f"Hashing {len(hashing)} new or changed files")
+        for record, stat, future in hashing:
+            record.md5 = future.result()
+            if hash_cache is not None:
+                hash_cache.store(record.path, stat, record.md5)
+        if metrics is not None:
+            metrics.count("files_hashed", len(hashing))
+            metrics.count("bytes_hashed", sum(x[1].st_size for x in hashing))
+            metrics.count("hash_seconds", time.monotonic() - hash_start)
+
+    if hash_cache is not None:
+        evicted = hash_cache.evict(root_path, seen_paths)
+        if evicted:
+            log.info(f"Evicted {evicted} stale entries from hash cache")
+        hash_cache.commit()
+    if metrics is not None:
+        metrics.count("files_scanned", len(file_list))
+    return file_list
+
+
+def scan_paths(
+    paths,
+    hash_cache=None,
+    metrics=None,
+    known=None,
+    strict=False,
+    rules=None,
+    defer=None,
+):
+    # Only the topmost of nested paths needs scanning, the walk covers the rest
+    tops = set()
+    for path in sorted(set(paths), key=lambda x: len(x.parts)):
+        if not any(x in tops for x in path.parents):
+            tops.add(path)
+
+    file_list = []
+    for path in tops:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        is_dir = stat_module.S_ISDIR(stat.st_mode)
+        if rules is not None and rules.ignored_tree(path, is_dir):
+            continue
+        if is_dir:
+            file_list.append(folder_record(path, stat))
+            if not path.is_symlink():
+                file_list.extend(
+                    scan_tree(
+                        path,
+                        hash_cache,
+                        metrics=metrics,
+                        known=known,
+                        strict=strict,
+                        rules=rules,
+                        defer=defer,
+                    )
+                )
+        elif not path.name.endswith(partial_suffix):
+            record = file_record(path, stat)
+            if rules is not None and rules.too_large(record.size):
+                file_list.append(record)
+                continue
+            if not strict:
+                record.md5 = known_md5(record, stat, hash_cache, known or {})
+            if record.md5 is None:
+                start = time.monotonic()
+                record.md5 = get_md5(path)
+                if hash_cache is not None:
+                    hash_cache.store(path, stat, record.md5)
+                if metrics is not None:
+                    metrics.count("files_hashed")
+                    metrics.count("bytes_hashed", stat.st_size)
+                    metrics.count("hash_seconds", time.monotonic() - start)
+            if metrics is not None:
+                metrics.count("files_scanned")
+            file_list.append(record)
+
+    if hash_cache is not None:
+        hash_cache.commit()
+    return file_list
@@ -0,0 +1,141 @@
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from utils import get_logger
+
+log = get_logger(__file__)
+
+
+def is_quota_error(error):
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    return error.resp.status == 403 and "RateLimitExceeded" in str(error.content)
+
+
+def is_retryable(error):
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if not isinstance(error, HttpError):
+        return False
+    return is_quota_error(error) or error.resp.status >= 500
+
+
+def retry_after(error):
+    try:
+        return float(error.resp.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, rate=None):
+        # Starts full. take may pass the rate for buckets whose rate changes
+        # over time; no rate means no limit
+        self.rate = rate
+        self.tokens = None
+        self.refilled = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, count, rate=None):
+        rate = self.rate if rate is None else rate
+        if not rate:
+            return 0.0
+        # Tokens may go negative, callers then wait until their share refills
+        with self.lock:
+            now = time.monotonic()
+            if self.tokens is None:
+                self.tokens = float(rate)
+            self.tokens = min(rate, self.tokens + (now - self.refilled) * rate)
+            self.refilled = now
+            self.tokens -= count
+            wait = -self.tokens / rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class Scheduler:
+    def __init__(
+        self,
+        requests_per_second=200,
+        max_concurrency=32,
+        min_concurrency=1,
+        retries=8,
+        base_delay=1.0,
+        max_delay=64.0,
+    ):
+        # One per account: every Drive call takes a token from the bucket and
+        # a slot under the concurrency limit. The limit grows by one per
+        # limit's worth of successful calls and halves on quota errors
+        self.bucket = TokenBucket(requests_per_second)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(min(8, max_concurrency))
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cond = threading.Condition()
+
+    def _acquire(self):
+        start = time.monotonic()
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+        return time.monotonic() - start
+
+    def _release(self, quota_error=False):
+        with self.cond:
+            self.in_flight -= 1
+            if quota_error:
+                self.throttle()
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def throttle(self):
+        with self.cond:
+            # Calls in flight together fail together, count them once
+            now = time.monotonic()
+            if now - self.last_decrease > 1.0:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                self.last_decrease = now
+                log.info(f"Quota exceeded, concurrency limit {int(self.limit)}")
+
+    def backoff(self, attempt, error=None, metrics=None):
+        # Full jitter, unless the server said how long to wait
+        delay = retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        if metrics is not None:
+            metrics.count("backoff_seconds", delay)
+        time.sleep(delay)
+
+    def call(self, func, *args, tokens=1, metrics=None):
+        for attempt in range(self.retries + 1):
+            waited = self.bucket.take(tokens) + self._acquire()
+            if metrics is not None and waited:
+                metrics.count("throttled_seconds", waited)
+            try:
+                result = func(*args)
+            except Exception as e:
+                quota_error = is_quota_error(e)
+                self._release(quota_error)
+                if metrics is not None and quota_error:
+                    metrics.count("quota_errors")
+                if not is_retryable(e) or attempt == self.retries:
+                    raise
+                log.info(f"Retrying after {type(e).__name__}: {e}")
+                if metrics is not None:
+                    metrics.count("retries")
+                self.backoff(attempt, e, metrics)
+                continue
+            self._release()
+            return result
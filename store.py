@@ -0,0 +1,284 @@
+import json
+import sqlite3
+import threading
+from collections import namedtuple
+
+
+class HashCache:
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(str(db_path))
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                inode INTEGER,
+                mtime INTEGER,
+                ctime INTEGER,
+                md5 TEXT
+            )
+            """
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def _stat_key(stat):
+        return (stat.st_size, stat.st_ino, stat.st_mtime_ns, stat.st_ctime_ns)
+
+    def lookup(self, path, stat):
+        row = self.conn.execute(
+            "SELECT size, inode, mtime, ctime, md5 FROM hashes WHERE path = ?",
+            (str(path),),
+        ).fetchone()
+        if row is not None and tuple(row[:4]) == self._stat_key(stat):
+            return row[4]
+        return None
+
+    def store(self, path, stat, md5):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+            (str(path), *self._stat_key(stat), md5),
+        )
+
+    def evict(self, root_path, seen_paths):
+        # Drop entries under root_path that were not seen in the latest scan
+        prefix = str(root_path).rstrip("/") + "/"
+        rows = self.conn.execute(
+            "SELECT path FROM hashes WHERE substr(path, 1, ?) = ?",
+            (len(prefix), prefix),
+        ).fetchall()
+        stale = [(x[0],) for x in rows if x[0] not in seen_paths]
+        if stale:
+            self.conn.executemany("DELETE FROM hashes WHERE path = ?", stale)
+        return len(stale)
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class CloudSnapshot:
+    def __init__(self, db_path):
+        # The parents of every file are kept apart too, to look up the
+        # contents of a folder
+        self.conn = sqlite3.connect(str(db_path))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cloud_files (id TEXT PRIMARY KEY, data TEXT)"
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cloud_parents (
+                id TEXT,
+                parent TEXT,
+                PRIMARY KEY (id, parent)
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS cloud_parents_parent ON cloud_parents (parent)"
+        )
+        # Snapshots from before the parents were kept
+        if len(self) and not self.conn.execute(
+            "SELECT 1 FROM cloud_parents LIMIT 1"
+        ).fetchone():
+            for page in list(self.pages()):
+                for file in page:
+                    self.put(file)
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM cloud_files").fetchone()[0]
+
+    def put(self, file):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cloud_files VALUES (?, ?)",
+            (file["id"], json.dumps(file)),
+        )
+        self.conn.execute("DELETE FROM cloud_parents WHERE id = ?", (file["id"],))
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO cloud_parents VALUES (?, ?)",
+            ((file["id"], x) for x in file.get("parents") or ()),
+        )
+
+    def get(self, file_id):
+        row = self.conn.execute(
+            "SELECT data FROM cloud_files WHERE id = ?", (file_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def children(self, folder_id):
+        rows = self.conn.execute(
+            "SELECT data FROM cloud_files JOIN cloud_parents USING (id) "
+            "WHERE parent = ?",
+            (folder_id,),
+        )
+        return [json.loads(x[0]) for x in rows]
+
+    def remove(self, file_id):
+        self.conn.execute("DELETE FROM cloud_files WHERE id = ?", (file_id,))
+        self.conn.execute("DELETE FROM cloud_parents WHERE id = ?", (file_id,))
+
+    def clear(self):
+        self.conn.execute("DELETE FROM cloud_files")
+        self.conn.execute("DELETE FROM cloud_parents")
+
+    def pages(self, page_size=1000):
+        cursor = self.conn.execute("SELECT data FROM cloud_files")
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                break
+            yield [json.loads(x[0]) for x in rows]
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class LockedStore:
+    # Shared by the transfer workers, so every use of the connection holds
+    # the lock. Rows are keyed by the local path
+    table = None
+    columns = None
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} "
+            f"(path TEXT PRIMARY KEY, {self.columns})"
+        )
+        self.conn.commit()
+
+    def fetch(self, columns, path):
+        with self.lock:
+            return self.conn.execute(
+                f"SELECT {columns} FROM {self.table} WHERE path = ?", (str(path),)
+            ).fetchone()
+
+    def write(self, row):
+        with self.lock:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} "
+                f"VALUES ({', '.join('?' * len(row))})",
+                row,
+            )
+            self.conn.commit()
+
+    def paths(self):
+        with self.lock:
+            return [x[0] for x in self.conn.execute(f"SELECT path FROM {self.table}")]
+
+    def remove(self, path):
+        with self.lock:
+            self.conn.execute(f"DELETE FROM {self.table} WHERE path = ?", (str(path),))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class UploadSessions(LockedStore):
+    table = "upload_sessions"
+    columns = "target TEXT, size INTEGER, mtime INTEGER, uri TEXT"
+
+    def get(self, path, target, stat):
+        row = self.fetch("target, size, mtime, uri", path)
+        if row is not None and tuple(row[:3]) == (
+            target,
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            return row[3]
+        return None
+
+    def put(self, path, target, stat, uri):
+        self.write((str(path), target, stat.st_size, stat.st_mtime_ns, uri))
+
+
+class DownloadSessions(LockedStore):
+    table = "download_sessions"
+    columns = "id TEXT, md5 TEXT"
+
+    def matches(self, path, file_id, md5):
+        # The partial file only continues the same version of the same file
+        row = self.fetch("id, md5", path)
+        return row is not None and tuple(row) == (file_id, md5)
+
+    def put(self, path, file_id, md5):
+        self.write((str(path), file_id, md5))
+
+
+StateRow = namedtuple("StateRow", "path id md5 size local_mtime cloud_mtime")
+
+
+class SyncState:
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(str(db_path))
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sync_state (
+                path TEXT PRIMARY KEY,
+                id TEXT,
+                md5 TEXT,
+                size INTEGER,
+                local_mtime REAL,
+                cloud_mtime REAL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS sync_state_id ON sync_state (id)"
+        )
+        self.conn.commit()
+
+    def rows(self, paths=None):
+        # With paths, only the rows at them or below them
+        if paths is None:
+            cursor = self.conn.execute("SELECT * FROM sync_state")
+            return [StateRow._make(x) for x in cursor]
+        rows = {}
+        for path in paths:
+            # Everything below a folder sorts between "folder/" and "folder0"
+            path = str(path).rstrip("/")
+            cursor = self.conn.execute(
+                "SELECT * FROM sync_state WHERE path = ? OR (path >= ? AND path < ?)",
+                (path, path + "/", path + "0"),
+            )
+            rows.update((x[0], StateRow._make(x)) for x in cursor)
+        return list(rows.values())
+
+    def get(self, path):
+        row = self.conn.execute(
+            "SELECT * FROM sync_state WHERE path = ?", (str(path),)
+        ).fetchone()
+        return StateRow._make(row) if row is not None else None
+
+    def by_id(self, file_id):
+        row = self.conn.execute(
+            "SELECT * FROM sync_state WHERE id = ?", (file_id,)
+        ).fetchone()
+        return StateRow._make(row) if row is not None else None
+
+    def put(self, rows):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?, ?, ?)", rows
+        )
+
+    def remove(self, paths):
+        self.conn.executemany(
+            "DELETE FROM sync_state WHERE path = ?", ((x,) for x in paths)
+        )
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
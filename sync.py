@@ -1,12 +1,26 @@
+import argparse
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 
 from yaml import safe_load
 
 from auth import get_creds
+from ignore import IgnoreRules
+from metrics import Metrics
 from model import GoogleDrive
-from utils import get_logger
+from store import (
+    CloudSnapshot,
+    DownloadSessions,
+    HashCache,
+    SyncState,
+    UploadSessions,
+)
+from transfers import TransferPolicy
+from utils import get_logger, set_log_context
+from watch import Inotify
 
 log = get_logger(__name__)
 data_path = Path.home() / ".drive_sync"
@@ -31,36 +45,329 @@ def save_status(status_path, status):
         json.dump(status, f)
 
 
+def open_account(service, account, account_config, profile=False):
+    status_path = data_path / f"{service}_{account}.status"
+
+    status = load_status(status_path)
+
+    start = time.monotonic()
+    log.info(f"Logging into `{service}` account `{account}`")
+    count = 0
+    while True:
+        count += 1
+        creds, success = get_creds(account)
+        if success:
+            break
+        if count > 3:
+            raise RuntimeError(f"{account} is not logged in")
+
+    root_path = Path(account_config["target"])
+    drive = GoogleDrive(
+        creds,
+        download_workers=account_config.get("download_workers", 8),
+        upload_workers=account_config.get("upload_workers", 4),
+        list_workers=account_config.get("list_workers", 8),
+        chunk_size=account_config.get("chunk_size", 10 * 1024 * 1024),
+        requests_per_second=account_config.get("requests_per_second", 200),
+        max_concurrency=account_config.get("max_concurrency", 32),
+        email_address=account,
+        started=start,
+        transfers=TransferPolicy.from_config(root_path, account_config),
+    )
+    db_path = data_path / f"{service}_{account}.db"
+    return {
+        "name": f"`{service}` account `{account}`",
+        "labels": {"service": service, "account": account},
+        "drive": drive,
+        # Looked up on the first pass, later runs take it from the status
+        "root_id": status.get("root_id"),
+        "root_path": root_path,
+        "rules": IgnoreRules.from_config(root_path, account_config) or None,
+        "status_path": status_path,
+        "status": status,
+        "report_path": status_path.with_suffix(".report.json"),
+        "plan_path": status_path.with_suffix(".plan.json"),
+        "metrics_path": status_path.with_suffix(".prom"),
+        "profile_path": status_path.with_suffix(".prof") if profile else None,
+        # Hash every local file instead of trusting sizes and mtimes
+        "strict": account_config.get("strict_hashing", False),
+        "hash_cache": HashCache(db_path),
+        "snapshot": CloudSnapshot(db_path),
+        "upload_sessions": UploadSessions(db_path),
+        "download_sessions": DownloadSessions(db_path),
+        "state": SyncState(db_path),
+    }
+
+
+def close_account(ctx):
+    ctx["hash_cache"].close()
+    ctx["snapshot"].close()
+    ctx["upload_sessions"].close()
+    ctx["download_sessions"].close()
+    ctx["state"].close()
+
+
+def sync_pass(ctx, paths=None, dry_run=False):
+    status = ctx["status"]
+    start_time = datetime.now().timestamp()
+    if paths is None:
+        log.info(f"Syncing {ctx['name']}")
+    else:
+        log.info(f"Syncing {len(paths)} changed paths in {ctx['name']}")
+    metrics = Metrics(profile_path=ctx["profile_path"])
+    ctx["drive"].metrics = metrics
+    try:
+        if ctx["root_id"] is None:
+            ctx["root_id"] = status["root_id"] = ctx["drive"].get_root()["id"]
+        plan = ctx["drive"].sync(
+            root_id=ctx["root_id"],
+            root_path=ctx["root_path"],
+            status=status,
+            dry_run=dry_run,
+            hash_cache=ctx["hash_cache"],
+            snapshot=ctx["snapshot"],
+            upload_sessions=ctx["upload_sessions"],
+            paths=paths,
+            state=ctx["state"],
+            download_sessions=ctx["download_sessions"],
+            strict=ctx["strict"],
+            rules=ctx["rules"],
+        )
+    finally:
+        # Failed runs get a report too, it shows how far they got
+        metrics.finish()
+        kind = "full" if paths is None else "partial"
+        if dry_run:
+            kind = "dry_run"
+        metrics.write_report(ctx["report_path"], **ctx["labels"], kind=kind)
+        if not dry_run:
+            metrics.write_prometheus(ctx["metrics_path"], **ctx["labels"], kind=kind)
+
+    if dry_run:
+        # Nothing changed, so the status stays as it was
+        log.info(f"Planned {len(plan)} operations for {ctx['name']}")
+        for line in plan.describe():
+            log.info(f"  {line}")
+        with ctx["plan_path"].open("w") as f:
+            json.dump(plan.to_dict(), f, indent=2)
+        log.info(f"Plan written to `{ctx['plan_path']}`")
+        return
+    log.info(f"Completed Syncing {ctx['name']}")
+    end_time = datetime.now().timestamp()
+
+    if paths is None:
+        status["start_time"] = start_time
+        status["end_time"] = end_time
+    save_status(ctx["status_path"], status)
+
+
+def sync_account(service, account, account_config, profile=False, dry_run=False):
+    set_log_context(f"{service}:{account}")
+    ctx = open_account(service, account, account_config, profile)
+    try:
+        sync_pass(ctx, dry_run=dry_run)
+    finally:
+        close_account(ctx)
+
+
+def watch_account(
+    service, account, account_config, debounce, poll_interval, profile=False
+):
+    set_log_context(f"{service}:{account}")
+    ctx = open_account(service, account, account_config, profile)
+    inotify = Inotify(ctx["rules"])
+    try:
+        # Watch before the first pass so nothing changed during it is lost
+        inotify.add_tree(ctx["root_path"])
+        full = True
+        failures = 0
+
+        dirty = set()
+        last_event = last_poll = time.monotonic()
+        while True:
+            try:
+                if full:
+                    full = False
+                    sync_pass(ctx)
+                    last_poll = time.monotonic()
+                now = time.monotonic()
+                if dirty:
+                    timeout = max(last_event + debounce - now, 0)
+                else:
+                    timeout = max(last_poll + poll_interval - now, 0)
+                paths = inotify.read(timeout)
+                now = time.monotonic()
+                if paths:
+                    dirty.update(paths)
+                    last_event = now
+
+                if inotify.overflowed:
+                    log.info("Too many changes to track, running a full sync")
+                    inotify.overflowed = False
+                    dirty = set()
+                    sync_pass(ctx)
+                elif dirty and now - last_event >= debounce:
+                    paths, dirty = dirty, set()
+                    # The pass takes in cloud changes under the paths, any
+                    # elsewhere call for the whole tree
+                    last_poll = now
+                    if ctx["drive"].poll_changes(
+                        ctx["root_id"],
+                        ctx["root_path"],
+                        ctx["status"],
+                        ctx["snapshot"],
+                        ctx["state"],
+                        ctx["rules"],
+                        paths,
+                    ):
+                        sync_pass(ctx)
+                    else:
+                        sync_pass(ctx, paths=paths)
+
+                # Changes the passes made themselves come back in the feed,
+                # only others' need a pass
+                if now - last_poll >= poll_interval:
+                    last_poll = now
+                    if ctx["drive"].poll_changes(
+                        ctx["root_id"],
+                        ctx["root_path"],
+                        ctx["status"],
+                        ctx["snapshot"],
+                        ctx["state"],
+                        ctx["rules"],
+                    ):
+                        sync_pass(ctx)
+                failures = 0
+            except Exception:  # pylint: disable=broad-except
+                # A failure never stops the watcher. Paths pending when it
+                # happened may be lost, so the retry is a full pass
+                failures += 1
+                delay = min(poll_interval, 2**failures)
+                log.exception(f"Watching {ctx['name']} failed, retrying in {delay}s")
+                time.sleep(delay)
+                full = True
+                dirty = set()
+    finally:
+        inotify.close()
+        close_account(ctx)
+
+
+def timed_sync(service, account, account_config, profile=False, dry_run=False):
+    start = time.monotonic()
+    try:
+        sync_account(service, account, account_config, profile, dry_run)
+        return time.monotonic() - start, None
+    except Exception as e:  # pylint: disable=broad-except
+        log.exception(f"Syncing `{service}` account `{account}` failed")
+        return time.monotonic() - start, e
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sync local folders with Drive")
+    parser.add_argument(
+        "--accounts",
+        type=int,
+        default=4,
+        help="number of accounts to sync at the same time",
+    )
+    parser.add_argument(
+        "--max-requests",
+        type=int,
+        default=32,
+        help="cap on concurrent transfers and listings across all accounts",
+    )
+    for direction in ("upload", "download"):
+        parser.add_argument(
+            f"--{direction}-limit",
+            type=float,
+            help=f"{direction} bytes per second across all accounts",
+        )
+        parser.add_argument(
+            f"--{direction}-schedule",
+            action="append",
+            default=[],
+            metavar="HH:MM-HH:MM=RATE",
+            help=f"{direction} bytes per second across all accounts at those "
+            "times of day, overriding the limit; may be repeated",
+        )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and sync changes as they happen",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=2.0,
+        help="seconds without local changes before pushing them",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=60.0,
+        help="seconds between checks for changes in the cloud",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="write a cProfile dump of the classification step next to the status",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="log the planned operations and write them next to the status",
+    )
+    return parser.parse_args()
+
+
 def main():
-    for service, service_config in config.items():
-        for account, account_config in service_config.items():
-            status_path = data_path / f"{service}_{account}.status"
-
-            status = load_status(status_path)
-
-            log.info(f"Logging into `{service}` account `{account}`")
-            count = 0
-            while True:
-                count += 1
-                creds, success = get_creds(account)
-                if success:
-                    break
-                if count > 3:
-                    raise RuntimeError(f"{account} is not logged in")
-
-            drive = GoogleDrive(creds)
-            root_id = drive.get_root()["id"]
-            root_path = Path(account_config["target"])
-
-            start_time = datetime.now().timestamp()
-            log.info(f"Syncing `{service}` account `{account}`")
-            drive.sync(root_id=root_id, root_path=root_path, status=status)
-            log.info(f"Completed Syncing `{service}` account `{account}`")
-            end_time = datetime.now().timestamp()
-
-            status["start_time"] = start_time
-            status["end_time"] = end_time
-            save_status(status_path, status)
+    args = parse_args()
+    GoogleDrive.set_request_limit(args.max_requests)
+    TransferPolicy.set_global_limit("upload", args.upload_limit, args.upload_schedule)
+    TransferPolicy.set_global_limit(
+        "download", args.download_limit, args.download_schedule
+    )
+
+    accounts = [
+        (service, account, account_config)
+        for service, service_config in config.items()
+        for account, account_config in service_config.items()
+    ]
+
+    if args.watch and not args.dry_run:
+        # Watchers never finish, so each account gets its own thread. One
+        # that stops, like on a failed login, is reported as soon as it does
+        with ThreadPoolExecutor(max_workers=max(len(accounts), 1)) as pool:
+            futures = {
+                pool.submit(
+                    watch_account, *x, args.debounce, args.poll_interval, args.profile
+                ): x[:2]
+                for x in accounts
+            }
+            for future in as_completed(futures):
+                service, account = futures[future]
+                try:
+                    future.result()
+                except Exception:  # pylint: disable=broad-except
+                    log.exception(f"Watching `{service}` account `{account}` failed")
+        return
+
+    with ThreadPoolExecutor(max_workers=max(args.accounts, 1)) as pool:
+        futures = [
+            (x[:2], pool.submit(timed_sync, *x, args.profile, args.dry_run))
+            for x in accounts
+        ]
+        results = [(name, future.result()) for name, future in futures]
+
+    log.info("Sync summary")
+    failed = []
+    for (service, account), (duration, error) in results:
+        state = "ok" if error is None else f"failed: {error}"
+        log.info(f"  {service}:{account} {duration:.1f}s {state}")
+        if error is not None:
+            failed.append(account)
+    if failed:
+        raise RuntimeError(f"Sync failed for {', '.join(failed)}")
 
 
 if __name__ == "__main__":
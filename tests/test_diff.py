@@ -0,0 +1,143 @@
+from diff import CloudFile, classify, join
+from scan import LocalFile
+from store import StateRow
+
+modified = "2024-01-01T00:00:00Z"
+
+
+def cloud_file(path, md5="old", file_id=None, file_type="txt"):
+    file_id = file_id or f"id:{path}"
+    name = path.rsplit("/", 1)[1]
+    file = CloudFile(file_id, name, file_type, modified, 3, md5, None, None)
+    file.path = path
+    return file
+
+
+def cloud_folder(path, file_id=None):
+    return cloud_file(path, None, file_id, "folder")
+
+
+def local_file(path, md5="old", file_type="txt"):
+    return LocalFile(path, file_type, 0, 3 if file_type != "folder" else None, md5)
+
+
+def local_folder(path):
+    return local_file(path, None, "folder")
+
+
+def base_row(path, md5="old", file_id=None):
+    return StateRow(path, file_id or f"id:{path}", md5, 3, 0, 0)
+
+
+def run(cloud=(), local=(), base=(), track_moves=False):
+    entries, _ = join(cloud, local, base)
+    return classify(entries, track_moves)
+
+
+def paths(entries):
+    return sorted(x.path for x in entries)
+
+
+def test_unchanged():
+    changes = run(
+        [cloud_file("/r/a.txt")], [local_file("/r/a.txt")], [base_row("/r/a.txt")]
+    )
+    assert changes.unchanged == 1
+    assert changes.entries == []
+
+
+def test_new_cloud_file_downloads():
+    changes = run([cloud_file("/r/a.txt")])
+    assert paths(changes.download) == ["/r/a.txt"]
+
+
+def test_deleted_locally_deletes_in_cloud():
+    changes = run([cloud_file("/r/a.txt")], [], [base_row("/r/a.txt")])
+    assert paths(changes.delete_cloud) == ["/r/a.txt"]
+    assert changes.download == []
+
+
+def test_deleted_locally_but_changed_in_cloud_downloads():
+    changes = run([cloud_file("/r/a.txt", "new")], [], [base_row("/r/a.txt")])
+    assert paths(changes.download) == ["/r/a.txt"]
+    assert changes.delete_cloud == []
+
+
+def test_deleted_locally_but_replaced_in_cloud_downloads():
+    changes = run(
+        [cloud_file("/r/a.txt", file_id="other")], [], [base_row("/r/a.txt")]
+    )
+    assert paths(changes.download) == ["/r/a.txt"]
+
+
+def test_deleted_in_cloud_deletes_locally():
+    changes = run([], [local_file("/r/a.txt")], [base_row("/r/a.txt")])
+    assert paths(changes.delete_local) == ["/r/a.txt"]
+    assert changes.upload == []
+
+
+def test_deleted_in_cloud_but_changed_locally_uploads():
+    changes = run([], [local_file("/r/a.txt", "new")], [base_row("/r/a.txt")])
+    assert paths(changes.upload) == ["/r/a.txt"]
+    assert changes.delete_local == []
+
+
+def test_gone_on_both_sides_only_leaves_the_state():
+    changes = run([], [], [base_row("/r/a.txt")])
+    assert changes.only_base == ["/r/a.txt"]
+    assert changes.entries == []
+
+
+def test_folder_deleted_locally_stays_for_a_new_cloud_file():
+    changes = run(
+        [cloud_folder("/r/f"), cloud_file("/r/f/old.txt"), cloud_file("/r/f/new.txt")],
+        [],
+        [base_row("/r/f"), base_row("/r/f/old.txt")],
+    )
+    assert paths(changes.download) == ["/r/f", "/r/f/new.txt"]
+    assert paths(changes.delete_cloud) == ["/r/f/old.txt"]
+
+
+def test_folder_deleted_in_cloud_stays_for_a_local_edit():
+    changes = run(
+        [],
+        [
+            local_folder("/r/f"),
+            local_folder("/r/f/sub"),
+            local_file("/r/f/sub/edited.txt", "new"),
+            local_file("/r/f/same.txt"),
+        ],
+        [
+            base_row("/r/f"),
+            base_row("/r/f/sub"),
+            base_row("/r/f/sub/edited.txt"),
+            base_row("/r/f/same.txt"),
+        ],
+    )
+    assert paths(changes.upload) == ["/r/f", "/r/f/sub", "/r/f/sub/edited.txt"]
+    assert paths(changes.delete_local) == ["/r/f/same.txt"]
+
+
+def test_edit_on_one_side_wins():
+    changes = run(
+        [cloud_file("/r/a.txt", "cloud"), cloud_file("/r/b.txt")],
+        [local_file("/r/a.txt"), local_file("/r/b.txt", "local")],
+        [base_row("/r/a.txt"), base_row("/r/b.txt")],
+    )
+    assert paths(changes.update_local) == ["/r/a.txt"]
+    assert paths(changes.update_cloud) == ["/r/b.txt"]
+
+
+def test_local_rename_becomes_a_move():
+    changes = run(
+        [cloud_file("/r/a.txt")],
+        [local_file("/r/b.txt")],
+        [base_row("/r/a.txt")],
+        track_moves=True,
+    )
+    assert [(str(x), str(y)) for x, y in changes.local_moves] == [
+        ("/r/a.txt", "/r/b.txt")
+    ]
+    assert changes.upload == []
+    assert changes.delete_cloud == []
+    assert [x.id for x in changes.moved_up] == ["id:/r/a.txt"]
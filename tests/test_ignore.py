@@ -0,0 +1,85 @@
+import re
+
+from ignore import IgnoreRules, compile_rule, glob_to_regex
+
+
+def matches(pattern, path):
+    return re.fullmatch(glob_to_regex(pattern), path) is not None
+
+
+def test_star_stays_in_one_folder():
+    assert matches("*.log", "a.log")
+    assert not matches("*.log", "a/b.log")
+
+
+def test_double_star():
+    assert matches("**/x", "x")
+    assert matches("**/x", "a/b/x")
+    assert matches("a/**", "a/b/c")
+    assert not matches("a/**", "b/c")
+
+
+def test_question_mark():
+    assert matches("a?c", "abc")
+    assert not matches("a?c", "a/c")
+    assert not matches("a?c", "ac")
+
+
+def test_character_classes():
+    assert matches("[ab].txt", "a.txt")
+    assert not matches("[ab].txt", "c.txt")
+    assert matches("[!ab].txt", "c.txt")
+    assert not matches("[!ab].txt", "a.txt")
+    assert matches("x[", "x[")
+
+
+def test_special_characters_are_literal():
+    assert matches("a+b.txt", "a+b.txt")
+    assert not matches("a.txt", "abtxt")
+
+
+def test_compile_rule_skips_blanks_and_comments():
+    assert compile_rule("") is None
+    assert compile_rule("   ") is None
+    assert compile_rule("# note") is None
+
+
+def test_compile_rule_flags():
+    regex, negate, dir_only = compile_rule("!build/")
+    assert negate and dir_only
+    assert regex.fullmatch("build")
+    assert regex.fullmatch("a/build")
+
+
+def test_compile_rule_anchored():
+    regex, _, _ = compile_rule("/docs")
+    assert regex.fullmatch("docs")
+    assert not regex.fullmatch("a/docs")
+    regex, _, _ = compile_rule("a/docs")
+    assert regex.fullmatch("a/docs")
+    assert not regex.fullmatch("b/a/docs")
+
+
+def test_last_rule_wins():
+    rules = IgnoreRules("/r", ["*.log"], ["keep.log"])
+    assert rules.ignored("/r/a.log")
+    assert not rules.ignored("/r/keep.log")
+
+
+def test_folder_rules_skip_files():
+    rules = IgnoreRules("/r", ["build/"])
+    assert rules.ignored("/r/build", True)
+    assert not rules.ignored("/r/build")
+
+
+def test_ignored_tree_covers_contents():
+    rules = IgnoreRules("/r", ["node_modules/"])
+    assert rules.ignored_tree("/r/a/node_modules/x/y.js")
+    assert not rules.ignored_tree("/r/a/src/y.js")
+
+
+def test_excluded_types():
+    rules = IgnoreRules("/r", exclude_types=["video/*"])
+    assert rules.ignored("/r/a.mp4")
+    assert not rules.ignored("/r/a.txt")
+    assert not rules.ignored("/r/clips", True)
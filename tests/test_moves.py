@@ -0,0 +1,108 @@
+from pathlib import Path
+
+from diff import CloudFile, Entry
+from moves import collapse_folder_moves, find_cloud_moves, find_local_moves
+from scan import LocalFile
+from store import StateRow
+
+
+def entry(path, file_id=None, cloud=False, local=None, base=None, folder=False):
+    # local and base are md5s, None leaves the side out; folders have none
+    file_type = "folder" if folder else "txt"
+    item = Entry(path)
+    if cloud:
+        name = Path(path).name
+        item.cloud = CloudFile(file_id, name, file_type, None, 3, None, None, None)
+        item.cloud.path = path
+        item.id = file_id
+    if local is not None:
+        item.local = LocalFile(path, file_type, 0, 3, local or None)
+    if base is not None:
+        item.base = StateRow(path, file_id, base or None, 3, 0, 0)
+    return item
+
+
+def as_str(pairs):
+    return sorted((str(x), str(y)) for x, y in pairs)
+
+
+def same(old, new):
+    return True
+
+
+def test_collapse_renamed_folder():
+    pairs = [(Path("/r/a/x"), Path("/r/b/x")), (Path("/r/a/y"), Path("/r/b/y"))]
+    old_paths = {Path(x) for x in ("/r/a", "/r/a/x", "/r/a/y")}
+    new_paths = {Path(x) for x in ("/r/b", "/r/b/x", "/r/b/y")}
+    ops, covered = collapse_folder_moves(pairs, old_paths, new_paths, same)
+    assert as_str(ops) == [("/r/a", "/r/b")]
+    assert as_str(covered.items()) == [
+        ("/r/a", "/r/b"),
+        ("/r/a/x", "/r/b/x"),
+        ("/r/a/y", "/r/b/y"),
+    ]
+
+
+def test_collapse_topmost_folder_only():
+    pairs = [(Path("/r/a/s/x"), Path("/r/b/s/x"))]
+    old_paths = {Path(x) for x in ("/r/a", "/r/a/s", "/r/a/s/x")}
+    new_paths = {Path(x) for x in ("/r/b", "/r/b/s", "/r/b/s/x")}
+    ops, _ = collapse_folder_moves(pairs, old_paths, new_paths, same)
+    assert as_str(ops) == [("/r/a", "/r/b")]
+
+
+def test_no_collapse_when_most_files_stay_behind():
+    pairs = [(Path("/r/a/x"), Path("/r/b/x"))]
+    old_paths = {Path(x) for x in ("/r/a", "/r/a/x", "/r/a/y", "/r/a/z")}
+    new_paths = {Path(x) for x in ("/r/b", "/r/b/x")}
+    ops, covered = collapse_folder_moves(pairs, old_paths, new_paths, same)
+    assert as_str(ops) == [("/r/a/x", "/r/b/x")]
+    assert Path("/r/a") not in covered
+
+
+def test_no_collapse_across_renamed_files():
+    pairs = [(Path("/r/a/x"), Path("/r/b/y"))]
+    old_paths = {Path(x) for x in ("/r/a", "/r/a/x")}
+    new_paths = {Path(x) for x in ("/r/b", "/r/b/y")}
+    ops, _ = collapse_folder_moves(pairs, old_paths, new_paths, same)
+    assert as_str(ops) == [("/r/a/x", "/r/b/y")]
+
+
+def test_local_folder_rename():
+    deleted = [
+        entry("/r/a", "A", cloud=True, base="", folder=True),
+        entry("/r/a/x", "X", cloud=True, base="mx"),
+        entry("/r/a/y", "Y", cloud=True, base="my"),
+    ]
+    added = [
+        entry("/r/b", local="", folder=True),
+        entry("/r/b/x", local="mx"),
+        entry("/r/b/y", local="my"),
+    ]
+    ops, covered = find_local_moves(deleted, added)
+    assert as_str(ops) == [("/r/a", "/r/b")]
+    assert len(covered) == 3
+
+
+def test_local_move_prefers_the_same_name():
+    deleted = [
+        entry("/r/a/copy", "C", cloud=True, base="m"),
+        entry("/r/a/x", "X", cloud=True, base="m"),
+    ]
+    added = [entry("/r/c/x", local="m")]
+    ops, _ = find_local_moves(deleted, added)
+    assert as_str(ops) == [("/r/a/x", "/r/c/x")]
+
+
+def test_cloud_folder_rename():
+    deleted = [
+        entry("/r/a", "A", local="", base="", folder=True),
+        entry("/r/a/x", "X", local="mx", base="mx"),
+    ]
+    added = [
+        entry("/r/b", "A", cloud=True, folder=True),
+        entry("/r/b/x", "X", cloud=True),
+    ]
+    ops, covered = find_cloud_moves(deleted, added)
+    assert as_str(ops) == [("/r/a", "/r/b")]
+    assert as_str(covered.items()) == [("/r/a", "/r/b"), ("/r/a/x", "/r/b/x")]
@@ -0,0 +1,131 @@
+from datetime import datetime
+
+from ignore import IgnoreRules
+from scheduler import TokenBucket
+from utils import thread_pool
+
+directions = ("upload", "download")
+
+
+def parse_clock(value):
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def parse_window(value):
+    # "HH:MM-HH:MM=bytes per second", windows past midnight wrap around
+    times, rate = value.split("=")
+    start, end = times.split("-")
+    return parse_clock(start), parse_clock(end), float(rate)
+
+
+def in_window(minute, start, end):
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+
+class BandwidthLimit:
+    def __init__(self, rate=None, schedule=()):
+        # Token bucket over bytes. The first window of the schedule covering
+        # the time of day sets the rate, the default rate applies outside
+        # them. No rate means no limit
+        self.rate = rate
+        self.schedule = [parse_window(x) for x in schedule]
+        self.bucket = TokenBucket()
+
+    @classmethod
+    def from_config(cls, config, direction):
+        rate = config.get(f"{direction}_limit")
+        schedule = config.get(f"{direction}_schedule") or ()
+        if not rate and not schedule:
+            return None
+        return cls(rate, schedule)
+
+    def current_rate(self, now=None):
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            if in_window(minute, start, end):
+                return rate
+        return self.rate
+
+    def consume(self, count):
+        return self.bucket.take(count, self.current_rate())
+
+
+class TransferPolicy:
+    # Limits shared by every account, set once at startup
+    global_limits = {x: None for x in directions}
+
+    def __init__(
+        self,
+        root_path=None,
+        order="size",
+        pinned=(),
+        large_file_size=64 * 1024 * 1024,
+        large_workers=2,
+        limits=None,
+    ):
+        # Transfers start pinned paths first, then the smallest or the most
+        # recently modified files. Files over large_file_size go in a lane of
+        # their own, so small edits never queue behind them
+        if order not in ("size", "recent"):
+            raise ValueError(f"Unknown transfer order `{order}`")
+        self.order = order
+        # Pins take the same patterns as the ignore rules
+        self.pinned = IgnoreRules(root_path, pinned) if pinned else None
+        self.large_file_size = large_file_size
+        self.large_workers = large_workers
+        self.limits = limits or {}
+
+    @classmethod
+    def from_config(cls, root_path, config):
+        return cls(
+            root_path,
+            config.get("transfer_order", "size"),
+            config.get("pinned", ()),
+            config.get("large_file_size", 64 * 1024 * 1024),
+            config.get("large_workers", 2),
+            {x: BandwidthLimit.from_config(config, x) for x in directions},
+        )
+
+    @classmethod
+    def set_global_limit(cls, direction, rate=None, schedule=()):
+        limit = BandwidthLimit(rate, schedule)
+        cls.global_limits[direction] = limit if rate or schedule else None
+
+    def priority(self, path, size, mtime):
+        pinned = self.pinned is not None and self.pinned.ignored_tree(path)
+        if self.order == "recent":
+            return not pinned, -(mtime or 0)
+        return not pinned, size or 0
+
+    def is_large(self, size):
+        return size is not None and size > self.large_file_size
+
+    def throttle(self, direction, metrics=None):
+        limits = [
+            x
+            for x in (self.limits.get(direction), self.global_limits[direction])
+            if x is not None
+        ]
+        if not limits:
+            return None
+
+        def throttle(count):
+            waited = sum(x.consume(count) for x in limits)
+            if metrics is not None and waited:
+                metrics.count(f"{direction}_shaped_seconds", waited)
+
+        return throttle
+
+    def run(self, items, func, size, workers):
+        # Items start in the order given; large ones in their own pool, both
+        # lanes moving at the same time. Results come back in the same order
+        lanes = [self.is_large(size(x)) for x in items]
+        with thread_pool(workers) as pool, thread_pool(self.large_workers) as large:
+            futures = [
+                (large if x else pool).submit(func, y) for x, y in zip(lanes, items)
+            ]
+            return [x.result() for x in futures]
@@ -1,18 +1,109 @@
+import fcntl
 import hashlib
 import logging
 import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Suffix for in-flight downloads, renamed into place once complete
+partial_suffix = ".dspart"
+
+# ioctl that shares extents between files on btrfs, xfs and similar
+FICLONE = 0x40049409
+
+_context = threading.local()
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.context = getattr(_context, "name", "-")
+        return True
+
+
+def set_log_context(name):
+    _context.name = name
+
+
+def get_log_context():
+    return getattr(_context, "name", "-")
+
+
+def thread_pool(max_workers):
+    # Worker threads log under the context of the thread that started them
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=set_log_context,
+        initargs=(get_log_context(),),
+    )
 
 
 def get_logger(name):
-    log_format = "[%(asctime)s][%(levelname)-5s]" "[%(name)s][%(funcName)s] %(message)s"
+    log_format = (
+        "[%(asctime)s][%(levelname)-5s][%(context)s]"
+        "[%(name)s][%(funcName)s] %(message)s"
+    )
     logging.basicConfig(level=logging.INFO, format=log_format)
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(x, ContextFilter) for x in handler.filters):
+            handler.addFilter(ContextFilter())
     logging.getLogger("googleapiclient").setLevel(logging.ERROR)
     return logging.getLogger(os.path.basename(name))
 
 
-def get_md5(path):
-    hash_md5 = hashlib.md5()
-    with path.open("rb") as f:
+def md5_file(path, hash_md5=None):
+    hash_md5 = hash_md5 or hashlib.md5()
+    with open(path, "rb") as f:
         for chunk in iter(lambda: f.read(40960), b""):
             hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    return hash_md5
+
+
+def get_md5(path):
+    return md5_file(path).hexdigest()
+
+
+class HashingWriter:
+    # Hashes everything written through it, so content is verified while it
+    # streams in instead of being read back afterwards
+    def __init__(self, f, hash_md5=None):
+        self.f = f
+        self.md5 = hash_md5 or hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.f.write(data)
+
+
+class HashingReader:
+    # Hashes a file as an upload reads it. Chunks sent again after a retry
+    # are hashed once; hashed falls short of the size if reading skipped
+    # ahead, like a resumed upload does
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+        self.hashed = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+    def read(self, size=-1):
+        start = self.f.tell()
+        data = self.f.read(size)
+        if start <= self.hashed < start + len(data):
+            self.md5.update(data[self.hashed - start :])
+            self.hashed = start + len(data)
+        return data
+
+
+def copy_file(source, destination):
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, destination)
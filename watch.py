@@ -0,0 +1,107 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from pathlib import Path
+
+from utils import get_logger, partial_suffix
+
+log = get_logger(__file__)
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+watch_mask = (
+    IN_CLOSE_WRITE
+    | IN_ATTRIB
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+)
+event_header = struct.Struct("iIII")
+
+
+class Inotify:
+    def __init__(self, rules=None):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {}
+        self.overflowed = False
+        # Ignored folders are not watched and ignored paths not reported
+        self.rules = rules
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), watch_mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            log.warning(f"Unable to watch `{path}`: {os.strerror(errno)}")
+            return
+        self.watches[wd] = Path(path)
+
+    def add_tree(self, root_path):
+        # Returns everything found, so files created before the watch was in
+        # place are not missed
+        found = []
+        for root, dirs, files in os.walk(root_path):
+            if self.rules is not None:
+                dirs[:] = [
+                    x
+                    for x in dirs
+                    if not self.rules.ignored(os.path.join(root, x), True)
+                ]
+            self.add_watch(root)
+            found.extend(Path(root) / x for x in dirs + files)
+        return found
+
+    def read(self, timeout):
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if not ready:
+            return set()
+
+        paths = set()
+        data = os.read(self.fd, 1024 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = event_header.unpack_from(data, offset)
+            offset += event_header.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or not name:
+                continue
+
+            path = self.watches[wd] / os.fsdecode(name)
+            if path.name.endswith(partial_suffix):
+                continue
+            is_dir = bool(mask & IN_ISDIR)
+            if self.rules is not None and self.rules.ignored(path, is_dir):
+                continue
+            paths.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                paths.update(self.add_tree(path))
+        return paths
+
+    def close(self):
+        os.close(self.fd)